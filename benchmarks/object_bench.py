@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks for the object-mapping hot paths in toco.object, run offline against toco.memory.MemoryBackend.
+
+Run with ``python -m benchmarks.object_bench [--output results.json] [--filter name]``.  Results are emitted as JSON so
+they can be compared across commits.
+
+Memory benchmarks report the bytes each object adds on top of the item it was built from, measured with tracemalloc
+over MEMORY_BENCHMARK_COUNT objects.  The targets in MEMORY_TARGETS are what holding a large scan result in memory
+should cost, and each result says whether it's within its target.
+
+Import benchmarks time importing a module in a fresh interpreter, i.e. what it adds to a cold start, and report whether
+that pulled in boto3.
+'''
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+from toco import fields
+from toco.memory import MemoryBackend
+from toco.memory import _normalize_item
+from toco.object import TocoObject, VERSION_KEY, blob, ensure_ddbsafe, load_from_fkey
+from datetime import datetime
+
+BENCHMARKS = []
+MEMORY_BENCHMARKS = []
+# (name, module) pairs for run_import_benchmark.
+IMPORT_BENCHMARKS = [
+    ("import_toco", "toco"),
+    ("import_toco_object", "toco.object"),
+]
+
+# How many objects each memory benchmark builds.
+MEMORY_BENCHMARK_COUNT = 10000
+
+# Bytes per object, on top of the raw item, that each memory benchmark should stay under.
+MEMORY_TARGETS = {
+    "memory_per_object":500,
+    "memory_per_object_lazy":200,
+}
+
+def benchmark(name):
+    '''
+    Register a benchmark.  The decorated function does any setup and returns the zero-argument callable to time.
+    '''
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+def memory_benchmark(name):
+    '''
+    Register a memory benchmark.  The decorated function does any setup and returns a callable that builds objects from a list of items.
+    '''
+    def register(setup):
+        MEMORY_BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+class BenchModel(TocoObject):
+    pass
+
+class Item(BenchModel):
+    @classmethod
+    def _SCHEMA(cls):
+        return {
+            "TableName":"bench_items",
+            "KeySchema":[{"AttributeName":"id","KeyType":"HASH"}],
+            "AttributeDefinitions":[{"AttributeName":"id","AttributeType":"S"}],
+        }
+
+class TypedItem(Item):
+    _FIELDS = {"name":fields.String(), "count":fields.Int(), "tags":fields.List(fields.String()), "owner":fields.String(), "created":fields.DateTime()}
+
+ATTRS = {"name":"widget", "count":12, "tags":["a", "b", "c"], "owner":"someone", "created":"datetime:2018-01-01T00:00:00.000000Z"}
+
+def _nested_document(depth=4, width=5):
+    if depth == 0:
+        return {"s":"value", "f":1.5, "d":datetime(2018, 1, 1), "e":"", "i":7}
+    return {"k{}".format(i):_nested_document(depth-1, width) if i % 2 == 0 else [_nested_document(depth-1, 2)] for i in range(width)}
+
+def _setup_backend():
+    backend = MemoryBackend()
+    BenchModel._BACKEND = backend
+    Item.create_table()
+    return backend
+
+@benchmark("construct_no_load")
+def bench_construct_no_load():
+    return lambda: Item(id="a", _attempt_load=False, **ATTRS)
+
+@benchmark("construct_with_load")
+def bench_construct_with_load():
+    _setup_backend()
+    Item(id="a", _attempt_load=False, **ATTRS)._save()
+    return lambda: Item(id="a", _attempt_load=True)
+
+@benchmark("getattr")
+def bench_getattr():
+    obj = Item(id="a", _attempt_load=False, **ATTRS)
+    return lambda: obj.name
+
+@benchmark("getattr_datetime")
+def bench_getattr_datetime():
+    obj = Item(id="a", _attempt_load=False, **ATTRS)
+    return lambda: obj.created
+
+@benchmark("getattr_datetime_declared")
+def bench_getattr_datetime_declared():
+    obj = TypedItem(id="a", _attempt_load=False, **ATTRS)
+    return lambda: obj.created
+
+@benchmark("item_to_store_declared")
+def bench_item_to_store_declared():
+    obj = TypedItem(id="a", _attempt_load=False, **ATTRS)
+    return obj._item_to_store
+
+@benchmark("setattr")
+def bench_setattr():
+    obj = Item(id="a", _attempt_load=False, **ATTRS)
+    def run():
+        obj.count = 13
+    return run
+
+@benchmark("foreign_key")
+def bench_foreign_key():
+    obj = Item(id="a", _attempt_load=False, **ATTRS)
+    return obj._foreign_key
+
+@benchmark("load_from_fkey_round_trip")
+def bench_load_from_fkey():
+    _setup_backend()
+    obj = Item(id="a", _attempt_load=False, **ATTRS)
+    obj._save()
+    fkey = obj._foreign_key()
+    return lambda: load_from_fkey(fkey).name
+
+@benchmark("fkey_attribute_access")
+def bench_fkey_attribute_access():
+    _setup_backend()
+    target = Item(id="target", _attempt_load=False, **ATTRS)
+    target._save()
+    obj = Item(id="a", _attempt_load=False, ref=target)
+    obj._save()
+    obj = Item._from_item(Item.TABLE().get_item(Key={"id":"a"})["Item"])
+    return lambda: obj.ref
+
+@benchmark("ensure_ddbsafe_nested")
+def bench_ensure_ddbsafe():
+    document = _nested_document()
+    return lambda: ensure_ddbsafe(document)
+
+@benchmark("parse_items_1mb_page")
+def bench_parse_items():
+    backend = _setup_backend()
+    for i in range(5000):
+        Item.TABLE().put_item(Item=dict(ATTRS, id="item-{:05d}".format(i), body="x" * 150))
+    response = Item.TABLE().scan()
+    assert "LastEvaluatedKey" in response
+    return lambda: Item._parse_items(response)
+
+@benchmark("parse_items_1mb_page_lazy")
+def bench_parse_items_lazy():
+    backend = _setup_backend()
+    for i in range(5000):
+        Item.TABLE().put_item(Item=dict(ATTRS, id="item-{:05d}".format(i), body="x" * 150))
+    response = Item.TABLE().scan()
+    return lambda: [(obj.name, obj.count) for obj in Item._parse_items(response, lazy=True)]
+
+@benchmark("nexttoken_round_trip")
+def bench_nexttoken():
+    key = {"id":"item-00001", "n":12345}
+    return lambda: Item._decode_nexttoken(Item._encode_nexttoken(key))
+
+@benchmark("blob_construction")
+def bench_blob():
+    return lambda: blob(ATTRS)
+
+@benchmark("blob_construction_wide")
+def bench_blob_wide():
+    item = {"attr{}".format(i):i for i in range(50)}
+    return lambda: blob(item)
+
+@benchmark("blob_getattr")
+def bench_blob_getattr():
+    b = blob(ATTRS)
+    return lambda: b.name
+
+@benchmark("blob_setitem")
+def bench_blob_setitem():
+    b = blob(ATTRS)
+    def setitem():
+        b["name"] = "gadget"
+    return setitem
+
+@memory_benchmark("memory_per_object")
+def bench_memory_per_object():
+    _setup_backend()
+    return lambda items: Item._parse_items({"Items":items})
+
+@memory_benchmark("memory_per_object_lazy")
+def bench_memory_per_object_lazy():
+    _setup_backend()
+    def build(items):
+        objs = Item._parse_items({"Items":items}, lazy=True)
+        for obj in objs:
+            obj.name
+        return objs
+    return build
+
+def run_memory_benchmark(name, setup, count=MEMORY_BENCHMARK_COUNT):
+    '''
+    Measure how much memory the objects built by the callable returned by setup hold on to, beyond their items.
+
+    :rtype: dict with bytes_per_object, and the target and whether it was met if there is one
+    '''
+    build = setup()
+    items = [_normalize_item(dict(ATTRS, id="item-{:05d}".format(i), **{VERSION_KEY:1})) for i in range(count)]
+    tracemalloc.start()
+    try:
+        objs = build(items)
+        allocated = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    result = {"bytes_per_object":allocated / len(objs), "objects":len(objs)}
+    if name in MEMORY_TARGETS:
+        result["target"] = MEMORY_TARGETS[name]
+        result["within_target"] = result["bytes_per_object"] <= MEMORY_TARGETS[name]
+    return result
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed, "boto3" in sys.modules)
+"""
+
+def run_import_benchmark(module, repeat=5):
+    '''
+    Time importing module in repeat fresh interpreters.
+
+    :rtype: dict of timing statistics in seconds, and whether the import loaded boto3
+    '''
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", _IMPORT_SCRIPT.format(module=module)]).decode("utf-8").split()
+        runs.append(float(output[0]))
+        boto3_imported = output[1] == "True"
+    return {"best":min(runs), "mean":sum(runs) / len(runs), "runs":repeat, "boto3_imported":boto3_imported}
+
+def run_benchmark(setup, repeat=5, min_time=0.2):
+    '''
+    Time the callable returned by setup, auto-scaling the number of calls per run so each run takes at least min_time.
+
+    :rtype: dict of timing statistics, in seconds per call
+    '''
+    func = setup()
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 10 ** 7:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    runs = [timer.timeit(number) / number for _ in range(repeat)]
+    return {"best":min(runs), "mean":sum(runs) / len(runs), "calls_per_run":number, "runs":repeat}
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        return None
+
+def run(names=None, repeat=5, min_time=0.2):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = run_benchmark(setup, repeat=repeat, min_time=min_time)
+    for name, setup in MEMORY_BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = run_memory_benchmark(name, setup)
+    for name, module in IMPORT_BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = run_import_benchmark(module, repeat=repeat)
+    return {
+        "commit":_git_commit(),
+        "python":platform.python_version(),
+        "timestamp":time.time(),
+        "results":results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument("--filter", action="append", help="Only run benchmarks whose names contain this (repeatable).")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per timed run.")
+    args = parser.parse_args(argv)
+    results = json.dumps(run(names=args.filter, repeat=args.repeat, min_time=args.min_time), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(results)
+    else:
+        print(results)
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,6 @@
 #!/usr/bin/env python3
+
+from . import cfcache, config
+from .fanout import gather
+from .session import session, current_session
+from .transaction import transaction, transact_get
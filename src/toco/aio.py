@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+'''
+Async versions of the toco operations that talk to DynamoDB, for use from asyncio code.
+
+Usage::
+
+    user = await User.aload(id="u1")
+    user.name = "new name"
+    await user.asave()
+    async for post in Post.aiter_query(user_id="u1"):
+        author = await post.aresolve("user")
+    users = await asyncio.gather(*[User.aload(id=i) for i in ids])
+
+The blocking calls run on one shared, bounded thread pool (MAX_WORKERS threads however many coroutines are waiting),
+and at most TABLE_CONCURRENCY of them run at once for any one table, whichever classes they're made through, so a
+coroutine that fans out over a big list of keys doesn't starve everything else.  Calls run in a copy of the caller's
+context, so an active toco.session() is seen by them.
+'''
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import weakref
+
+# Threads shared by every async toco call in the process.
+MAX_WORKERS = 32
+# How many calls for the same table can be running at once; the rest wait their turn without holding a thread.
+TABLE_CONCURRENCY = 8
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+# Semaphores belong to an event loop, so there's a set of limits for each loop.
+_LIMITS = weakref.WeakKeyDictionary()
+
+def configure(max_workers=None, table_concurrency=None):
+    '''
+    Change the executor size and/or the per-table limit.  Takes effect for calls made afterwards.
+    '''
+    global _EXECUTOR, MAX_WORKERS, TABLE_CONCURRENCY
+    with _EXECUTOR_LOCK:
+        if max_workers is not None and max_workers != MAX_WORKERS:
+            MAX_WORKERS = max_workers
+            if _EXECUTOR is not None:
+                _EXECUTOR.shutdown(wait=False)
+                _EXECUTOR = None
+        if table_concurrency is not None:
+            TABLE_CONCURRENCY = table_concurrency
+            _LIMITS.clear()
+
+def _executor():
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _EXECUTOR_LOCK:
+            if _EXECUTOR is None:
+                _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="toco-aio")
+    return _EXECUTOR
+
+def _limit(clazz):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    limits = _LIMITS.get(loop)
+    if limits is None:
+        limits = _LIMITS[loop] = {}
+    table_name = clazz.TABLE_NAME()
+    if table_name not in limits:
+        limits[table_name] = asyncio.Semaphore(TABLE_CONCURRENCY)
+    return limits[table_name]
+
+async def run(clazz, func, *args, **kwargs):
+    '''
+    Run func(*args, **kwargs) on the executor, within the concurrency limit of clazz's table.
+
+    :param clazz: The toco class whose table func reads or writes.
+    :rtype: Whatever func returns
+    '''
+    # asyncio is imported here rather than at the top so that importing toco doesn't pay for it; callers already have.
+    import asyncio
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    async with _limit(clazz):
+        return await asyncio.get_running_loop().run_in_executor(_executor(), call)
+
+async def iter_search(clazz, operation, max_items=None, max_pages=None, prefetch=None, fields=None, **kwargs):
+    '''
+    Async generator behind aiter_query and aiter_scan.  Pages are fetched one at a time on the executor.
+    '''
+    params = clazz._projection_params(fields, clazz._preprocess_search_params(**kwargs))
+    count = 0
+    pages = 0
+    while True:
+        results = await run(clazz, clazz._call_table, operation, **params)
+        pages += 1
+        if prefetch:
+            items = await run(clazz, clazz._postprocess_search_results, results, prefetch=prefetch, fields=fields)
+            items = items["Items"]
+        else:
+            items = [clazz._from_item(item, fields=fields) for item in results.get("Items", [])]
+        for item in items:
+            if max_items is not None and count >= max_items:
+                return
+            count += 1
+            yield item
+        last_key = results.get("LastEvaluatedKey", None)
+        if not last_key or (max_pages is not None and pages >= max_pages):
+            return
+        params = dict(params, ExclusiveStartKey=last_key)
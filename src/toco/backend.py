@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+'''
+Backends are what toco objects talk to in place of a boto3 DynamoDB service resource.
+
+A backend needs to provide the same subset of the service resource's interface that toco uses:
+Table(name) (returning something with get_item, put_item, update_item, delete_item, query and scan),
+batch_get_item, batch_write_item and create_table.
+
+It also needs transact_write_items and transact_get_items, which the service resource doesn't have.  These take the
+same arguments as the client methods, except that (as with the resource's methods) items, keys and values are plain
+Python values and conditions may be boto3.dynamodb.conditions objects.
+
+boto3 is slow to import, so it's only imported once a Boto3Backend actually makes a call; importing toco doesn't need it.
+'''
+
+import threading
+
+from . import config
+
+def _build_transact_conditions(transact_items):
+    '''
+    Build any boto3.dynamodb.conditions objects in TransactItems into expression strings, with their placeholders kept
+    in the request they belong to.  The client only knows how to do this for top-level conditions; the values are left
+    as they are, as it serializes those itself.
+    '''
+    from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+    built_items = []
+    for transact_item in transact_items:
+        built_item = {}
+        for action, request in transact_item.items():
+            condition = request.get("ConditionExpression", None)
+            if isinstance(condition, ConditionBase):
+                built = ConditionExpressionBuilder().build_expression(condition)
+                request = dict(request, ConditionExpression=built.condition_expression)
+                names = dict(request.get("ExpressionAttributeNames", {}), **built.attribute_name_placeholders)
+                values = dict(request.get("ExpressionAttributeValues", {}), **built.attribute_value_placeholders)
+                if names:
+                    request["ExpressionAttributeNames"] = names
+                if values:
+                    request["ExpressionAttributeValues"] = values
+            built_item[action] = request
+        built_items.append(built_item)
+    return built_items
+
+class Boto3Backend(object):
+    '''
+    The default backend, which talks to DynamoDB through boto3.
+
+    Every thread shares one low-level client, which is thread-safe and owns the connection pool.  boto3's service
+    resources and Table objects aren't thread-safe, so each thread gets its own, built on that client.
+
+    With no arguments the client is built from toco.config's settings (pool size, timeouts, retries).
+
+    :param resource_kwargs: If given, passed through to boto3.resource('dynamodb', ...) instead.
+    '''
+    def __init__(self, **resource_kwargs):
+        self._resource_kwargs = resource_kwargs
+        self._client = None
+        self._resource_class = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        '''
+        The shared low-level client.  It has the resource's (de)serialization registered on it, so it takes and returns
+        plain Python values just as the resource does.
+        '''
+        if self._client is None:
+            # Several threads can need the client at once, and only one of them should build it.
+            with self._lock:
+                if self._client is None:
+                    resource = config.build("resource", "dynamodb", **self._resource_kwargs)
+                    self._resource_class = type(resource)
+                    self._client = resource.meta.client
+        return self._client
+
+    @property
+    def resource(self):
+        '''
+        This thread's service resource.
+        '''
+        resource = getattr(self._local, "resource", None)
+        if resource is None:
+            client = self.client
+            resource = self._local.resource = self._resource_class(client=client)
+            self._local.tables = {}
+        return resource
+
+    def Table(self, name):
+        resource = self.resource
+        tables = self._local.tables
+        if name not in tables:
+            tables[name] = resource.Table(name)
+        return tables[name]
+
+    def batch_get_item(self, **kwargs):
+        return self.resource.batch_get_item(**kwargs)
+
+    def batch_write_item(self, **kwargs):
+        return self.resource.batch_write_item(**kwargs)
+
+    def create_table(self, **schema):
+        return self.client.create_table(**schema)
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        # The client (de)serializes items, keys and values itself, just as the resource does.
+        return self.client.transact_write_items(TransactItems=_build_transact_conditions(TransactItems), **kwargs)
+
+    def transact_get_items(self, **kwargs):
+        return self.client.transact_get_items(**kwargs)
+
+_BACKEND = None
+
+def get_backend():
+    '''
+    The backend used by any class that doesn't set its own _BACKEND.  Defaults to a Boto3Backend.
+    '''
+    global _BACKEND
+    if not _BACKEND:
+        _BACKEND = Boto3Backend()
+    return _BACKEND
+
+def set_backend(backend):
+    '''
+    Replace the default backend, e.g. with a toco.memory.MemoryBackend for tests and benchmarks.
+
+    :param backend: The new backend, or None to go back to a fresh Boto3Backend.
+    '''
+    global _BACKEND
+    _BACKEND = backend
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+'''
+Read-through caching of items for toco classes that opt in.
+
+A class enables it by setting _CACHE_SIZE (and optionally _CACHE_TTL, in seconds)::
+
+    class Session(TocoObject):
+        _CACHE_SIZE = 10000
+        _CACHE_TTL = 30
+
+load(), load_many() and foreign key reloads are then served from the cache when possible, and saves and deletes made
+through toco invalidate the affected entries.  Caches belong to tables rather than classes, so writes made through any
+class on a table (cached or not) invalidate the entries every other class on it reads.
+'''
+
+import collections
+import copy
+import threading
+import time
+
+# How long an invalidation keeps older versions of an item out of a cache with no TTL.
+TOMBSTONE_TTL = 60
+
+class ObjectCache(object):
+    '''
+    A thread-safe, size-bounded LRU cache of raw items, keyed by key identity.
+
+    Entries remember the version (VERSION_KEY) of the item they hold, and a put with an older version than the entry
+    already has is ignored.  Invalidating with a version leaves a tombstone behind, so a read that started before a save
+    can't put the pre-save item back afterwards.  Writes that don't bump the version (atomic updates) leave a tombstone
+    that rejects that version too.
+
+    :param max_size: Maximum number of entries (including tombstones).
+    :param ttl: Seconds an entry stays valid, or None for no expiry.
+    :param version_key: The item attribute holding its version.
+    '''
+    def __init__(self, max_size, ttl=None, version_key="version_toco_"):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_key = version_key
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_puts = 0
+
+    def _expires_at(self, ttl):
+        return time.time() + ttl if ttl is not None else None
+
+    def _live_entry(self, identity):
+        entry = self._entries.get(identity, None)
+        if entry is not None and entry[0] is not None and entry[0] <= time.time():
+            del self._entries[identity]
+            self.expirations += 1
+            return None
+        return entry
+
+    def get(self, identity):
+        '''
+        :rtype: A copy of the cached item, or None on a miss.
+        '''
+        with self._lock:
+            entry = self._live_entry(identity)
+            if entry is None or entry[1] is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(identity)
+            self.hits += 1
+            item = entry[1]
+        return copy.deepcopy(item)
+
+    def put(self, identity, item):
+        version = item.get(self.version_key, 0)
+        item = copy.deepcopy(item)
+        with self._lock:
+            entry = self._live_entry(identity)
+            if entry is not None and (version < entry[2] or (version == entry[2] and entry[3])):
+                self.stale_puts += 1
+                return False
+            self._entries[identity] = (self._expires_at(self.ttl), item, version, False)
+            self._entries.move_to_end(identity)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, identity, version=None, inclusive=False):
+        '''
+        Drop the entry for identity.  If version is given, items older than it can't be cached again until the tombstone expires.
+
+        :param inclusive: Keep out items at version itself as well, for writes that changed the item without bumping its version.
+        '''
+        with self._lock:
+            if version is None:
+                self._entries.pop(identity, None)
+            else:
+                self._entries[identity] = (self._expires_at(self.ttl if self.ttl is not None else TOMBSTONE_TTL), None, version, inclusive)
+                self._entries.move_to_end(identity)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size":len(self._entries),
+                "hits":self.hits,
+                "misses":self.misses,
+                "evictions":self.evictions,
+                "expirations":self.expirations,
+                "stale_puts":self.stale_puts,
+            }
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+'''
+A persistent, on-disk cache of the CloudFormation lookups CFObject classes make (stack templates and table resources),
+so a new process doesn't have to call CloudFormation again.
+
+Usage::
+
+    class Model(CFObject):
+        _CF_CACHE_FILE = "/var/task/toco-cf-cache.json"
+
+    # At deploy time, with CloudFormation access:
+    toco.cfcache.prebuild([User, Post, Comment])
+
+Entries are kept per stack, along with the stack's last update time, and are discarded if a later lookup finds the
+stack has been updated since.  By default lookups trust the file rather than checking the update time, so a prebuilt
+file means no CloudFormation calls at all; set _CF_CACHE_VERIFY on the class to check it instead (one DescribeStacks
+call per stack per process).  CFObject._clear_cf_cache() drops the class's stack from the file as well as from memory.
+
+If the file can't be written (e.g. it's in a read-only deployment package), a warning is logged and what's fetched is
+kept in memory instead, so a cache miss costs a CloudFormation call rather than failing the lookup.
+'''
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+_FILES = {}
+_FILES_LOCK = threading.Lock()
+
+class CFCacheFile(object):
+    '''
+    One cache file, shared by every class that names the same path.  Writes replace the file atomically.
+
+    :param path: Where the cache lives.  Created on the first write.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = None
+        # Set once a write fails, after which the in-memory data has entries the file doesn't.
+        self._unwritable = False
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, data):
+        self._data = data
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".toco-cf-cache-")
+        except OSError as e:
+            self._write_failed(e)
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, default=str, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            os.unlink(tmp)
+            self._write_failed(e)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _write_failed(self, error):
+        if not self._unwritable:
+            logger.warning("Unable to write CloudFormation cache file {}, keeping entries in memory: {}".format(self.path, error))
+        self._unwritable = True
+
+    def _current(self):
+        # Start from what's on disk, so entries written by other processes aren't lost, unless the file is out of date.
+        return dict(self._data) if self._unwritable else self._read()
+
+    def get(self, stack_name, name, updated=None):
+        '''
+        :param name: What's being looked up, e.g. "template" or "resource:<logical name>".
+        :param updated: The stack's current update time, if known; entries from other versions of the stack are ignored.
+        :rtype: The cached value, or None.
+        '''
+        with self._lock:
+            if self._data is None:
+                self._data = self._read()
+            entry = self._data.get(stack_name)
+        if not entry or (updated is not None and entry["updated"] != updated):
+            return None
+        return entry["values"].get(name)
+
+    def put(self, stack_name, updated, name, value):
+        with self._lock:
+            data = self._current()
+            entry = data.get(stack_name)
+            if not entry or entry["updated"] != updated:
+                entry = data[stack_name] = {"updated":updated, "values":{}}
+            entry["values"][name] = value
+            self._write(data)
+
+    def invalidate(self, stack_name=None):
+        '''
+        Drop everything cached for stack_name, or for every stack if it's None.
+        '''
+        with self._lock:
+            data = self._current()
+            if stack_name is None:
+                data = {}
+            else:
+                data.pop(stack_name, None)
+            self._write(data)
+
+def cache_file(path):
+    '''
+    :rtype: The CFCacheFile for path.
+    '''
+    with _FILES_LOCK:
+        if path not in _FILES:
+            _FILES[path] = CFCacheFile(path)
+        return _FILES[path]
+
+def prebuild(classes):
+    '''
+    Look up (and so write to their cache files) the template and table resource of each CFObject class, ignoring anything already cached.
+
+    :param classes: The CFObject classes (with their stack and logical names set, e.g. from lazysubclass) the deployed code will use.
+    :rtype: Dict of class to table name.
+    '''
+    classes = list(classes)
+    # Each stack is dropped once up front, as classes sharing a stack also share its entries.
+    stacks = set((clazz._CF_CACHE_FILE, clazz._get_stack_name()) for clazz in classes if clazz._CF_CACHE_FILE)
+    for path, stack_name in stacks:
+        cache_file(path).invalidate(stack_name)
+    tables = {}
+    for clazz in classes:
+        clazz._clear_cf_cache(persistent=False)
+        tables[clazz] = clazz.TABLE_NAME()
+    return tables
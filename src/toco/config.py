@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+'''
+Process-wide settings for how toco talks to AWS.
+
+Usage::
+
+    toco.config.configure(max_pool_connections=64, read_timeout=5, retry_mode="adaptive")
+    toco.config.prewarm([User, Post])    # at startup, so the first requests don't pay for connection setup
+
+Every class without its own _BACKEND shares the default Boto3Backend, which builds one DynamoDB client (and with it
+one connection pool) from these settings.  The CloudFormation client CFObject uses is built from them too, when it's
+first needed.  configure() replaces both, so call it at startup, before the first request.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+class Config(object):
+    '''
+    :param region_name: AWS region, or None for boto3's usual lookup.
+    :param endpoint_url: DynamoDB endpoint, e.g. for DynamoDB Local.
+    :param max_pool_connections: Size of the HTTP connection pool.  Should be at least the number of threads making toco calls at once.
+    :param connect_timeout: Seconds to wait for a connection.
+    :param read_timeout: Seconds to wait for a response.
+    :param retry_mode: botocore retry mode: "legacy", "standard" or "adaptive".
+    :param max_attempts: Attempts per call, including the first.
+    :param tcp_keepalive: Turn on TCP keepalive, so idle pooled connections aren't silently dropped.
+    '''
+    def __init__(self, region_name=None, endpoint_url=None, max_pool_connections=50, connect_timeout=5, read_timeout=10, retry_mode="standard", max_attempts=5, tcp_keepalive=True):
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url
+        self.max_pool_connections = max_pool_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry_mode = retry_mode
+        self.max_attempts = max_attempts
+        self.tcp_keepalive = tcp_keepalive
+
+    def botocore_config(self):
+        '''
+        :rtype: botocore.config.Config
+        '''
+        from botocore.config import Config as BotocoreConfig
+        return BotocoreConfig(
+            max_pool_connections=self.max_pool_connections,
+            connect_timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            retries={"mode":self.retry_mode, "total_max_attempts":self.max_attempts},
+            tcp_keepalive=self.tcp_keepalive,
+        )
+
+    def client_kwargs(self, service="dynamodb"):
+        '''
+        :rtype: Keyword arguments for boto3's client() or resource() for service.
+        '''
+        kwargs = {"config":self.botocore_config()}
+        if self.region_name:
+            kwargs["region_name"] = self.region_name
+        if self.endpoint_url and service == "dynamodb":
+            kwargs["endpoint_url"] = self.endpoint_url
+        return kwargs
+
+_CONFIG = Config()
+_LOCK = threading.Lock()
+_SESSION = None
+
+def get_config():
+    '''
+    :rtype: The current Config.
+    '''
+    return _CONFIG
+
+def configure(**settings):
+    '''
+    Change the settings (any of Config's arguments; the rest keep their current values), and replace the default backend and the CloudFormation client so they take effect.
+
+    :rtype: The new Config.
+    '''
+    global _CONFIG
+    from .backend import set_backend
+    from .object import CFObject
+    values = dict(vars(_CONFIG))
+    values.update(settings)
+    _CONFIG = Config(**values)
+    set_backend(None)
+    CFObject._CF_CLIENT = None
+    return _CONFIG
+
+def session():
+    '''
+    The boto3 Session toco's clients and resources are built from.  Creating clients from the default session isn't thread-safe, so toco uses its own, and builds everything from it under a lock.
+
+    :rtype: boto3.session.Session
+    '''
+    global _SESSION
+    with _LOCK:
+        if _SESSION is None:
+            import boto3.session
+            _SESSION = boto3.session.Session()
+        return _SESSION
+
+def build(factory, service, **kwargs):
+    '''
+    Build a boto3 client or resource for service, holding the lock that makes doing so thread-safe.
+
+    :param factory: "client" or "resource".
+    :param kwargs: Passed to boto3 in place of the current settings, if given.
+    '''
+    s = session()
+    with _LOCK:
+        return getattr(s, factory)(service, **(kwargs if kwargs else get_config().client_kwargs(service)))
+
+def prewarm(classes=None, connections=None):
+    '''
+    Open connections ahead of the first real request, if the default backend is a Boto3Backend: builds the shared client, then makes concurrent DescribeTable calls for the given classes' tables (or DescribeEndpoints calls, if there are none) so that many connections are in the pool.
+
+    :param classes: toco classes whose tables will be used, which also checks that they exist.
+    :param connections: How many connections to open.  Defaults to max_pool_connections.
+    :rtype: The number of calls made.
+    '''
+    from .backend import Boto3Backend, get_backend
+    backend = get_backend()
+    if not isinstance(backend, Boto3Backend):
+        # e.g. a MemoryBackend, which has no connections to open.
+        return 0
+    classes = list(classes) if classes else []
+    connections = connections if connections else get_config().max_pool_connections
+    client = backend.client
+    if classes:
+        table_names = [clazz.TABLE_NAME() for clazz in classes]
+        calls = [table_names[i % len(table_names)] for i in range(max(connections, len(table_names)))]
+        call = lambda table_name: client.describe_table(TableName=table_name)
+    else:
+        calls = range(connections)
+        call = lambda i: client.describe_endpoints()
+    with ThreadPoolExecutor(max_workers=min(len(calls), get_config().max_pool_connections)) as executor:
+        list(executor.map(call, calls))
+    return len(calls)
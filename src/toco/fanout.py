@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+'''
+Load objects of many classes from many tables at once.
+
+Usage::
+
+    result = toco.gather([(User, {"id":"u1"}), (Post, {"user_id":"u1", "n":3}), order.customer_fkey])
+    user, post, customer = result["Items"]
+    result["Missing"]     # the requests that weren't found
+
+Requests are grouped by backend and sent as multi-table BatchGetItem calls of up to BATCH_GET_LIMIT keys (across all
+tables), which run concurrently on a thread pool.  The session and read-through caches are checked first, as with
+load_many.
+'''
+
+from .object import CONSTANT_FKEYS, _key_identity, _parse_fkey, batch_get_items, get_class, is_foreign_key
+from .session import current_session
+
+# How many BatchGetItem calls gather() has in flight at once.
+GATHER_WORKERS = 8
+
+def _resolve_request(request):
+    if isinstance(request, tuple):
+        clazz, key = request
+        return clazz, clazz._key_from_dict(key)
+    if not is_foreign_key(request) or request in CONSTANT_FKEYS:
+        raise RuntimeError("Expected a (class, key) pair or a foreign key, not {!r}.".format(request))
+    clazzname, key, extras = _parse_fkey(request)
+    clazz = get_class(clazzname)._class_for_fkey(**extras)
+    return clazz, clazz._key_from_dict(key)
+
+def gather(requests, consistent_read=False, max_workers=GATHER_WORKERS):
+    '''
+    Load a mixed list of objects, from any number of classes and tables, with as few round trips as possible.
+
+    :param requests: Iterable of (class, key dict) pairs and/or foreign key strings.
+    :param consistent_read: Whether to use strongly consistent reads (which also skips the read-through caches).
+    :param max_workers: How many BatchGetItem calls to have in flight at once.
+    :rtype: dict with "Items", the objects in the same order as requests with None for any that weren't found, and "Missing", the requests that weren't found.
+    '''
+    requests = list(requests)
+    resolved = [_resolve_request(request) for request in requests]
+    session = current_session()
+    found = {}
+    # Per backend: the class its calls are issued through, the keys still to fetch by table, and the class wanted for each item.
+    wanted = {}
+    for clazz, key in resolved:
+        identity = clazz._identity(key)
+        if identity in found:
+            continue
+        if session is not None:
+            existing = clazz._session_get(key)
+            if existing is not None and existing._in_db and not existing._needs_reloaded:
+                found[identity] = existing
+                continue
+        cache = None if consistent_read else clazz.OBJECT_CACHE()
+        item = cache.get(identity[1]) if cache else None
+        if item is not None:
+            found[identity] = clazz._from_item(item)
+            continue
+        group = wanted.setdefault(id(clazz.RESOURCE()), {"class":clazz, "keys":{}, "classes":{}})
+        group["keys"].setdefault(identity[0], []).append(key)
+        group["classes"][identity] = clazz
+    for group in wanted.values():
+        items_by_table = batch_get_items(group["class"], group["keys"], consistent_read=consistent_read, max_workers=max_workers)
+        for table_name, items in items_by_table.items():
+            # Any class on the table can pick the key out of its items.
+            key_class = group["classes"][(table_name, _key_identity(group["keys"][table_name][0]))]
+            for item in items:
+                identity = (table_name, _key_identity(key_class._key_from_dict(item)))
+                clazz = group["classes"][identity]
+                cache = None if consistent_read else clazz.OBJECT_CACHE()
+                if cache:
+                    cache.put(identity[1], item)
+                found[identity] = clazz._from_item(item)
+    objs = [found.get(clazz._identity(key)) for clazz, key in resolved]
+    return {"Items":objs, "Missing":[request for request, obj in zip(requests, objs) if obj is None]}
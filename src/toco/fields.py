@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+'''
+Optional declarative types for the attributes of toco classes.
+
+Usage::
+
+    from toco import fields
+
+    class Order(TocoObject):
+        _FIELDS = {
+            "total":fields.Decimal(),
+            "quantity":fields.Int(),
+            "placed":fields.DateTime(),
+            "lines":fields.List(fields.Map(fields.Int())),
+            "customer":fields.ForeignKey("myapp.models.Customer"),
+        }
+
+A declared attribute is decoded by its field the first time it's read (and the result kept until the attribute
+changes or the object is reloaded), and encoded by its field when the object is saved.  Attributes that aren't
+declared keep toco's usual dynamic handling.  _FIELDS are merged down the class hierarchy and compiled once per class.
+'''
+
+from datetime import datetime
+import decimal
+
+from .object import CONSTANT_FKEYS, DATETIME_FORMAT, FKEY_EMPTY_STRING, TocoObject, ensure_ddbsafe, get_class, load_from_fkey
+
+class Field(object):
+    '''
+    Base class for field types.  None is always stored and read back as None.
+    '''
+    # Whether reading the attribute can load another object (and so counts as a lazy foreign key load).
+    loads_objects = False
+
+    def encode(self, value):
+        '''
+        :rtype: The value as it should be sent to DynamoDB.
+        '''
+        return None if value is None else self._encode(value)
+
+    def decode(self, value):
+        '''
+        :rtype: The value as it should be seen in Python.  Has to accept values that have already been decoded, as that's what's there after an attribute is set.
+        '''
+        return None if value is None else self._decode(value)
+
+    def _encode(self, value):
+        return value
+
+    def _decode(self, value):
+        return value
+
+class String(Field):
+    def _encode(self, value):
+        return value if value else FKEY_EMPTY_STRING
+
+    def _decode(self, value):
+        return CONSTANT_FKEYS.get(value, value)
+
+class Int(Field):
+    def _encode(self, value):
+        return int(value)
+
+    def _decode(self, value):
+        return int(value)
+
+class Float(Field):
+    def _encode(self, value):
+        # Via str, as DynamoDB won't take the inexact Decimal a float converts to directly.
+        return decimal.Decimal(str(value))
+
+    def _decode(self, value):
+        return float(value)
+
+class Decimal(Field):
+    def _encode(self, value):
+        return value if isinstance(value, decimal.Decimal) else decimal.Decimal(str(value))
+
+    def _decode(self, value):
+        return value if isinstance(value, decimal.Decimal) else decimal.Decimal(str(value))
+
+class Bool(Field):
+    def _encode(self, value):
+        return bool(value)
+
+    def _decode(self, value):
+        return bool(value)
+
+class Bytes(Field):
+    def _encode(self, value):
+        return _to_bytes(value)
+
+    def _decode(self, value):
+        return _to_bytes(value)
+
+class DateTime(Field):
+    '''
+    Stored in the same "datetime:..." string format that toco uses for undeclared datetimes.
+    '''
+    def _encode(self, value):
+        return value.strftime(DATETIME_FORMAT) if isinstance(value, datetime) else value
+
+    def _decode(self, value):
+        return datetime.strptime(value, DATETIME_FORMAT) if isinstance(value, str) else value
+
+class List(Field):
+    '''
+    :param of: The field type of the elements, or None to handle them dynamically.
+    '''
+    def __init__(self, of=None):
+        self.of = of
+
+    def _encode(self, value):
+        if self.of is None:
+            return ensure_ddbsafe(list(value))
+        return [self.of.encode(v) for v in value]
+
+    def _decode(self, value):
+        if self.of is None:
+            return list(value)
+        return [self.of.decode(v) for v in value]
+
+class Map(Field):
+    '''
+    :param of: The field type of the values, or None to handle them dynamically.
+    '''
+    def __init__(self, of=None):
+        self.of = of
+
+    def _encode(self, value):
+        if self.of is None:
+            return ensure_ddbsafe(dict(value))
+        return {k:self.of.encode(v) for k, v in value.items()}
+
+    def _decode(self, value):
+        if self.of is None:
+            return dict(value)
+        return {k:self.of.decode(v) for k, v in value.items()}
+
+class ForeignKey(Field):
+    '''
+    A reference to another toco object, stored as its foreign key.
+
+    :param to: The class (or its full name) that the object must be an instance of, or None to allow any toco object.
+    '''
+    loads_objects = True
+
+    def __init__(self, to=None):
+        self.to = to
+
+    def _target(self):
+        return get_class(self.to) if isinstance(self.to, str) else self.to
+
+    def _encode(self, value):
+        if isinstance(value, TocoObject):
+            if self.to is not None and not isinstance(value, self._target()):
+                raise RuntimeError("Expected an instance of {}, not {}.".format(self._target().CLASS_NAME(), value.__class__.CLASS_NAME()))
+            return value._foreign_key()
+        return value
+
+    def _decode(self, value):
+        return load_from_fkey(value) if isinstance(value, str) else value
+
+def _to_bytes(value):
+    # Anything but bytes is a boto3 Binary (or bytearray etc), so boto3 is only needed once one turns up.
+    if isinstance(value, bytes):
+        return value
+    from boto3.dynamodb.types import Binary
+    return bytes(value.value if isinstance(value, Binary) else value)
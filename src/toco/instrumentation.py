@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+'''
+Optional per-request instrumentation for toco's DynamoDB calls.
+
+Once enabled, every backend call made by a toco class is timed and recorded per class and operation, along with item
+counts, request payload size, retries (botocore's, and toco's batch re-submissions) and consumed capacity.  Lazy foreign key loads and reloads triggered from
+attribute access (the usual sources of N+1 query patterns) are counted as well.
+
+Usage::
+
+    instrumentation = toco.instrumentation.enable(exporter=print, export_interval=60)
+    ...
+    instrumentation.snapshot()
+'''
+
+import collections
+import json
+import threading
+import time
+
+# Event names passed to Instrumentation.count by toco.object.
+LAZY_FKEY_LOAD = "lazy_fkey_load"
+LAZY_RELOAD = "lazy_reload"
+
+# Operations that accept ReturnConsumedCapacity.
+_CAPACITY_OPERATIONS = ("get_item", "put_item", "update_item", "delete_item", "query", "scan", "batch_get_item", "batch_write_item", "transact_get_items", "transact_write_items")
+
+class Histogram(object):
+    '''
+    Keeps a bounded reservoir of the most recent samples, and reports percentiles over them.
+
+    :param size: How many recent samples to keep.
+    '''
+    def __init__(self, size=1024):
+        self._samples = collections.deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+    def snapshot(self):
+        return {
+            "count":self.count,
+            "mean":self.total / self.count if self.count else None,
+            "p50":self.percentile(50),
+            "p95":self.percentile(95),
+            "p99":self.percentile(99),
+            "max":self.max,
+        }
+
+class OperationStats(object):
+    '''
+    Everything recorded about one operation on one class.
+    '''
+    def __init__(self, reservoir_size=1024):
+        self.latency = Histogram(reservoir_size)
+        self.calls = 0
+        self.errors = 0
+        self.items = 0
+        self.payload_bytes = 0
+        self.retries = 0
+        self.consumed_capacity = 0.0
+
+    def snapshot(self):
+        return {
+            "calls":self.calls,
+            "errors":self.errors,
+            "items":self.items,
+            "payload_bytes":self.payload_bytes,
+            "retries":self.retries,
+            "consumed_capacity":self.consumed_capacity,
+            "latency":self.latency.snapshot(),
+        }
+
+def _item_count(response):
+    if "Items" in response:
+        return len(response["Items"])
+    if "Item" in response:
+        return 1
+    if isinstance(response.get("Responses", None), list):
+        # TransactGetItems
+        return sum(1 for entry in response["Responses"] if "Item" in entry)
+    if "Responses" in response:
+        return sum(len(items) for items in response["Responses"].values())
+    return 0
+
+def _consumed_capacity(response):
+    capacity = response.get("ConsumedCapacity", None)
+    if not capacity:
+        return 0.0
+    if isinstance(capacity, dict):
+        capacity = [capacity]
+    return float(sum(c.get("CapacityUnits", 0) for c in capacity))
+
+def _retry_attempts(response):
+    # How many times botocore retried the call before this response (or error).
+    return response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+
+def _payload_size(params):
+    return len(json.dumps(params, default=str))
+
+class Instrumentation(object):
+    '''
+    Aggregates call statistics and event counters per class.
+
+    :param exporter: Called with snapshot() by export(), and automatically every export_interval seconds if that's set.
+    :param export_interval: Seconds between automatic exports, or None to only export when asked.
+    :param reservoir_size: How many recent latency samples to keep per class and operation.
+    '''
+    def __init__(self, exporter=None, export_interval=None, reservoir_size=1024):
+        self.exporter = exporter
+        self.export_interval = export_interval
+        self._reservoir_size = reservoir_size
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._counters = collections.Counter()
+        self._last_export = time.time()
+
+    def _operation_stats(self, clazz_name, operation):
+        key = (clazz_name, operation)
+        if key not in self._stats:
+            self._stats[key] = OperationStats(self._reservoir_size)
+        return self._stats[key]
+
+    def call(self, clazz, operation, func, params):
+        '''
+        Make a backend call on behalf of clazz and record it.
+        '''
+        if operation in _CAPACITY_OPERATIONS and "ReturnConsumedCapacity" not in params:
+            params = dict(params, ReturnConsumedCapacity="TOTAL")
+        start = time.perf_counter()
+        try:
+            response = func(**params)
+        except Exception as e:
+            retries = _retry_attempts(getattr(e, "response", None) or {})
+            self.record(clazz.CLASS_NAME(), operation, time.perf_counter() - start, payload_bytes=_payload_size(params), retries=retries, error=True)
+            raise e
+        self.record(clazz.CLASS_NAME(), operation, time.perf_counter() - start, items=_item_count(response), payload_bytes=_payload_size(params), consumed_capacity=_consumed_capacity(response), retries=_retry_attempts(response))
+        return response
+
+    def record(self, clazz_name, operation, latency, items=0, payload_bytes=0, consumed_capacity=0.0, retries=0, error=False):
+        with self._lock:
+            stats = self._operation_stats(clazz_name, operation)
+            stats.calls += 1
+            stats.retries += retries
+            stats.errors += 1 if error else 0
+            stats.items += items
+            stats.payload_bytes += payload_bytes
+            stats.consumed_capacity += consumed_capacity
+            stats.latency.record(latency)
+        self._maybe_export()
+
+    def record_retry(self, clazz_name, operation):
+        with self._lock:
+            self._operation_stats(clazz_name, operation).retries += 1
+
+    def count(self, clazz_name, event):
+        with self._lock:
+            self._counters[(clazz_name, event)] += 1
+
+    def snapshot(self):
+        '''
+        :rtype: dict with "operations" (class name -> operation -> stats) and "events" (class name -> event -> count)
+        '''
+        with self._lock:
+            operations = {}
+            for (clazz_name, operation), stats in self._stats.items():
+                operations.setdefault(clazz_name, {})[operation] = stats.snapshot()
+            events = {}
+            for (clazz_name, event), count in self._counters.items():
+                events.setdefault(clazz_name, {})[event] = count
+        return {"operations":operations, "events":events}
+
+    def export(self):
+        self._last_export = time.time()
+        if self.exporter:
+            self.exporter(self.snapshot())
+
+    def _maybe_export(self):
+        if self.export_interval is not None and time.time() - self._last_export >= self.export_interval:
+            self.export()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._counters = collections.Counter()
+
+_INSTRUMENTATION = None
+
+def enable(exporter=None, export_interval=None, reservoir_size=1024):
+    '''
+    Start instrumenting every toco backend call.
+
+    :rtype: Instrumentation
+    '''
+    global _INSTRUMENTATION
+    _INSTRUMENTATION = Instrumentation(exporter=exporter, export_interval=export_interval, reservoir_size=reservoir_size)
+    return _INSTRUMENTATION
+
+def disable():
+    global _INSTRUMENTATION
+    _INSTRUMENTATION = None
+
+def get_instrumentation():
+    '''
+    :rtype: The active Instrumentation, or None if instrumentation isn't enabled.
+    '''
+    return _INSTRUMENTATION
@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+
+'''
+An in-process stand-in for DynamoDB, for running toco objects in tests and benchmarks without AWS.
+
+Usage::
+
+    backend = MemoryBackend()
+    set_backend(backend)  # or MyClass._BACKEND = backend
+    MyClass.create_table()
+
+Items are stored the way DynamoDB would return them (numbers as Decimal, binary as Binary, etc.), and the same
+type restrictions apply on the way in (floats are rejected, just as boto3 rejects them).
+Conditions must be boto3.dynamodb.conditions objects; UpdateExpression and ProjectionExpression strings are parsed.
+Transactions are applied atomically under the backend's lock.
+'''
+
+from botocore.exceptions import ClientError
+from boto3.dynamodb import conditions
+from boto3.dynamodb.types import Binary, TypeDeserializer, TypeSerializer
+import copy
+import decimal
+import math
+import random
+import re
+import threading
+import time
+import zlib
+
+from .object import KeySchema, _key_identity
+
+# DynamoDB stops reading a page once it has evaluated this many bytes of items.
+PAGE_SIZE = 1024 * 1024
+
+_SERIALIZER = TypeSerializer()
+_DESERIALIZER = TypeDeserializer()
+
+class _Missing(object):
+    pass
+
+_MISSING = _Missing()
+
+def _error(code, operation, message=""):
+    return ClientError({"Error":{"Code":code, "Message":message}}, operation)
+
+def _normalize(value):
+    # Round trip through the wire format, so values come back exactly as they would from DynamoDB.
+    return _DESERIALIZER.deserialize(_SERIALIZER.serialize(value))
+
+def _normalize_item(item):
+    return {k:_normalize(item[k]) for k in item}
+
+def _attribute_size(value):
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, Binary):
+        return len(value.value)
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, decimal.Decimal):
+        return len(str(value).lstrip("-").replace(".", "")) // 2 + 1
+    if isinstance(value, (set, frozenset)):
+        return sum(_attribute_size(v) for v in value)
+    if isinstance(value, list):
+        return 3 + sum(1 + _attribute_size(v) for v in value)
+    if isinstance(value, dict):
+        return 3 + sum(len(k.encode("utf-8")) + 1 + _attribute_size(value[k]) for k in value)
+    return len(str(value))
+
+def item_size(item):
+    '''
+    Approximate size of an item in bytes, as DynamoDB counts it for capacity and pagination.
+    '''
+    return sum(len(k.encode("utf-8")) + _attribute_size(item[k]) for k in item)
+
+def _orderable(value):
+    if isinstance(value, Binary):
+        return (2, value.value)
+    if isinstance(value, bytes):
+        return (2, value)
+    if isinstance(value, str):
+        return (1, value)
+    return (0, value)
+
+def _type_code(value):
+    if isinstance(value, str):
+        return "S"
+    if isinstance(value, bool):
+        return "BOOL"
+    if isinstance(value, decimal.Decimal):
+        return "N"
+    if isinstance(value, (Binary, bytes)):
+        return "B"
+    if value is None:
+        return "NULL"
+    if isinstance(value, list):
+        return "L"
+    if isinstance(value, dict):
+        return "M"
+    return _SERIALIZER.serialize(value).popitem()[0]
+
+_PATH_PART = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+def _split_path(path):
+    return [int(index) if index else name for name, index in _PATH_PART.findall(path)]
+
+def _resolve(item, parts):
+    value = item
+    for part in parts:
+        if isinstance(part, int):
+            if not isinstance(value, list) or part >= len(value):
+                return _MISSING
+        elif not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _operand(value, item):
+    if isinstance(value, conditions.Size):
+        resolved = _operand(value.get_expression()["values"][0], item)
+        if resolved is _MISSING:
+            return _MISSING
+        if isinstance(resolved, (str, bytes, Binary)):
+            return decimal.Decimal(_attribute_size(resolved))
+        return decimal.Decimal(len(resolved))
+    if isinstance(value, conditions.AttributeBase):
+        return _resolve(item, _split_path(value.name))
+    return _normalize(value)
+
+def _compare(operator, a, b):
+    if a is _MISSING or b is _MISSING:
+        return operator == "<>"
+    if operator == "=":
+        return a == b
+    if operator == "<>":
+        return a != b
+    if _orderable(a)[0] != _orderable(b)[0]:
+        return False
+    a, b = _orderable(a)[1], _orderable(b)[1]
+    if operator == "<":
+        return a < b
+    if operator == "<=":
+        return a <= b
+    if operator == ">":
+        return a > b
+    return a >= b
+
+def evaluate_condition(condition, item):
+    '''
+    Evaluate a boto3.dynamodb.conditions condition against an item (or {} for a missing item).
+
+    :rtype: bool
+    '''
+    if condition is None:
+        return True
+    if isinstance(condition, str):
+        raise NotImplementedError("MemoryBackend only supports boto3.dynamodb.conditions objects, not expression strings.")
+    operator = condition.expression_operator
+    values = condition.get_expression()["values"]
+    if operator == "AND":
+        return evaluate_condition(values[0], item) and evaluate_condition(values[1], item)
+    if operator == "OR":
+        return evaluate_condition(values[0], item) or evaluate_condition(values[1], item)
+    if operator == "NOT":
+        return not evaluate_condition(values[0], item)
+    if operator == "attribute_exists":
+        return _operand(values[0], item) is not _MISSING
+    if operator == "attribute_not_exists":
+        return _operand(values[0], item) is _MISSING
+    first = _operand(values[0], item)
+    if operator == "attribute_type":
+        return first is not _MISSING and _type_code(first) == values[1]
+    if operator == "IN":
+        return first is not _MISSING and first in [_normalize(v) for v in values[1]]
+    if operator == "BETWEEN":
+        return _compare(">=", first, _operand(values[1], item)) and _compare("<=", first, _operand(values[2], item))
+    second = _operand(values[1], item)
+    if first is _MISSING or second is _MISSING:
+        return False
+    if operator == "begins_with":
+        if isinstance(first, Binary):
+            first, second = first.value, second.value if isinstance(second, Binary) else second
+        return isinstance(first, type(second)) and first.startswith(second)
+    if operator == "contains":
+        if isinstance(first, str):
+            return isinstance(second, str) and second in first
+        if isinstance(first, (set, frozenset, list)):
+            return second in first
+        return False
+    return _compare(operator, first, second)
+
+_TOKEN = re.compile(r"\s*(?:(#\w+)|(:\w+)|([A-Za-z_]\w*)|\[(\d+)\]|(\S))")
+_UPDATE_ACTIONS = ("SET", "REMOVE", "ADD", "DELETE")
+
+class _ExpressionParser(object):
+    '''
+    Parses the UpdateExpression and ProjectionExpression grammars (as much of them as toco needs).
+    '''
+    def __init__(self, expression, names=None, values=None):
+        self._tokens = []
+        for match in _TOKEN.finditer(expression):
+            if match.group(1):
+                self._tokens.append(("name", (names or {})[match.group(1)]))
+            elif match.group(2):
+                self._tokens.append(("value", _normalize((values or {})[match.group(2)])))
+            elif match.group(3):
+                self._tokens.append(("ident", match.group(3)))
+            elif match.group(4):
+                self._tokens.append(("index", int(match.group(4))))
+            elif match.group(5):
+                self._tokens.append(("punct", match.group(5)))
+        self._position = 0
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self._position += 1
+        return token
+
+    def _expect(self, punct):
+        token = self._next()
+        if token != ("punct", punct):
+            raise _error("ValidationException", "UpdateItem", "Expected '{}' in expression".format(punct))
+
+    def path(self):
+        kind, value = self._next()
+        if kind not in ("name", "ident"):
+            raise _error("ValidationException", "UpdateItem", "Expected an attribute name in expression")
+        parts = [value]
+        while True:
+            kind, value = self._peek()
+            if kind == "index":
+                self._next()
+                parts.append(value)
+            elif (kind, value) == ("punct", "."):
+                self._next()
+                parts.append(self._next()[1])
+            else:
+                return parts
+
+    def _operand(self):
+        kind, value = self._peek()
+        if kind == "value":
+            self._next()
+            return ("value", value)
+        if kind == "ident" and value in ("if_not_exists", "list_append"):
+            self._next()
+            self._expect("(")
+            first = self.path() if value == "if_not_exists" else self._operand()
+            self._expect(",")
+            second = self._operand()
+            self._expect(")")
+            return (value, first, second)
+        return ("path", self.path())
+
+    def _value(self):
+        first = self._operand()
+        kind, value = self._peek()
+        if (kind, value) in (("punct", "+"), ("punct", "-")):
+            self._next()
+            return (value, first, self._operand())
+        return first
+
+    def update_actions(self):
+        actions = []
+        action = None
+        while self._peek()[0]:
+            kind, value = self._peek()
+            if kind == "ident" and value.upper() in _UPDATE_ACTIONS:
+                self._next()
+                action = value.upper()
+            elif (kind, value) == ("punct", ","):
+                self._next()
+            elif action == "SET":
+                path = self.path()
+                self._expect("=")
+                actions.append(("SET", path, self._value()))
+            elif action == "REMOVE":
+                actions.append(("REMOVE", self.path(), None))
+            elif action in ("ADD", "DELETE"):
+                path = self.path()
+                actions.append((action, path, self._operand()))
+            else:
+                raise _error("ValidationException", "UpdateItem", "Invalid UpdateExpression")
+        return actions
+
+    def paths(self):
+        paths = []
+        while self._peek()[0]:
+            paths.append(self.path())
+            if self._peek()[0]:
+                self._expect(",")
+        return paths
+
+def _evaluate_update_value(value, item):
+    kind = value[0]
+    if kind == "value":
+        return value[1]
+    if kind == "path":
+        return _resolve(item, value[1])
+    if kind == "if_not_exists":
+        existing = _resolve(item, value[1])
+        return existing if existing is not _MISSING else _evaluate_update_value(value[2], item)
+    first = _evaluate_update_value(value[1], item)
+    second = _evaluate_update_value(value[2], item)
+    if first is _MISSING or second is _MISSING:
+        raise _error("ValidationException", "UpdateItem", "The provided expression refers to an attribute that does not exist in the item")
+    if kind == "list_append":
+        return first + second
+    if kind == "+":
+        return first + second
+    return first - second
+
+def _set_path(item, parts, value):
+    target = item
+    for part in parts[:-1]:
+        target = target[part]
+    if isinstance(parts[-1], int) and parts[-1] >= len(target):
+        target.append(value)
+    else:
+        target[parts[-1]] = value
+
+def _remove_path(item, parts):
+    target = _resolve(item, parts[:-1])
+    if target is not _MISSING and _resolve(target, parts[-1:]) is not _MISSING:
+        del target[parts[-1]]
+
+def _project(item, paths):
+    projected = {}
+    for parts in paths:
+        if _resolve(item, parts) is _MISSING:
+            continue
+        indexes = [isinstance(part, int) for part in parts]
+        if True in indexes:
+            # List elements are projected along with the rest of their list.
+            parts = parts[:indexes.index(True)]
+        target = projected
+        source = item
+        for part in parts[:-1]:
+            source = source[part]
+            target = target.setdefault(part, {})
+        target[parts[-1]] = source[parts[-1]]
+    return projected
+
+class MemoryTable(object):
+    '''
+    A single in-memory table, created from the same schema dict that would be passed to create_table.
+    '''
+    def __init__(self, backend, schema):
+        self.backend = backend
+        self.name = schema["TableName"]
+        self.schema = copy.deepcopy(schema)
+        self.key_schema = KeySchema(schema)
+        self.items = {}
+
+    def _key(self, key, operation):
+        for name in self.key_schema.key_names:
+            if name not in key:
+                raise _error("ValidationException", operation, "The provided key element does not match the schema")
+        return _normalize_item({name:key[name] for name in self.key_schema.key_names})
+
+    def _capacity(self, response, kwargs, size, write=False, consistent=False):
+        if kwargs.get("ReturnConsumedCapacity", "NONE") in ("TOTAL", "INDEXES"):
+            if write:
+                units = max(1, math.ceil(size / 1024.0))
+            else:
+                units = max(1, math.ceil(size / 4096.0)) * (1.0 if consistent else 0.5)
+            response["ConsumedCapacity"] = {"TableName":self.name, "CapacityUnits":float(units)}
+        return response
+
+    def _return_values(self, return_values, old, new, updated=()):
+        if return_values in (None, "NONE"):
+            return None
+        if return_values == "ALL_OLD":
+            return old
+        if return_values == "ALL_NEW":
+            return new
+        source = old if return_values == "UPDATED_OLD" else new
+        return {k:source[k] for k in updated if source and k in source}
+
+    def _get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False, **kwargs):
+        key = self._key(Key, "GetItem")
+        with self.backend._lock:
+            item = copy.deepcopy(self.items.get(_key_identity(key)))
+        response = {}
+        size = item_size(item) if item else 0
+        if item is not None:
+            if ProjectionExpression:
+                item = _project(item, _ExpressionParser(ProjectionExpression, ExpressionAttributeNames).paths())
+            response["Item"] = item
+        return self._capacity(response, kwargs, size, consistent=ConsistentRead)
+
+    def _put_item(self, Item, ConditionExpression=None, ReturnValues="NONE", **kwargs):
+        item = _normalize_item(Item)
+        key = self._key(item, "PutItem")
+        with self.backend._lock:
+            old = self.items.get(_key_identity(key))
+            if not evaluate_condition(ConditionExpression, old if old else {}):
+                raise _error("ConditionalCheckFailedException", "PutItem", "The conditional request failed")
+            self.items[_key_identity(key)] = item
+        response = {}
+        returned = self._return_values(ReturnValues, old, item)
+        if returned is not None:
+            response["Attributes"] = copy.deepcopy(returned)
+        return self._capacity(response, kwargs, item_size(item), write=True)
+
+    def _update_item(self, Key, UpdateExpression=None, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, ReturnValues="NONE", **kwargs):
+        key = self._key(Key, "UpdateItem")
+        actions = _ExpressionParser(UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues).update_actions() if UpdateExpression else []
+        with self.backend._lock:
+            old = self.items.get(_key_identity(key))
+            if not evaluate_condition(ConditionExpression, old if old else {}):
+                raise _error("ConditionalCheckFailedException", "UpdateItem", "The conditional request failed")
+            before = copy.deepcopy(old) if old else dict(key)
+            new = copy.deepcopy(before)
+            updated = []
+            for action, path, value in actions:
+                if path[0] in self.key_schema.key_names:
+                    raise _error("ValidationException", "UpdateItem", "Cannot update attribute {}. This attribute is part of the key".format(path[0]))
+                if path[0] not in updated:
+                    updated.append(path[0])
+                if action == "SET":
+                    _set_path(new, path, _evaluate_update_value(value, before))
+                elif action == "REMOVE":
+                    _remove_path(new, path)
+                else:
+                    operand = _evaluate_update_value(value, before)
+                    existing = _resolve(new, path)
+                    if action == "ADD":
+                        if existing is _MISSING:
+                            existing = decimal.Decimal(0) if isinstance(operand, decimal.Decimal) else set()
+                        _set_path(new, path, existing + operand if isinstance(operand, decimal.Decimal) else existing | operand)
+                    elif existing is not _MISSING:
+                        remaining = existing - operand
+                        if remaining:
+                            _set_path(new, path, remaining)
+                        else:
+                            _remove_path(new, path)
+            self.items[_key_identity(key)] = new
+        response = {}
+        returned = self._return_values(ReturnValues, old, new, updated)
+        if returned is not None:
+            response["Attributes"] = copy.deepcopy(returned)
+        return self._capacity(response, kwargs, item_size(new), write=True)
+
+    def _delete_item(self, Key, ConditionExpression=None, ReturnValues="NONE", **kwargs):
+        key = self._key(Key, "DeleteItem")
+        with self.backend._lock:
+            old = self.items.get(_key_identity(key))
+            if not evaluate_condition(ConditionExpression, old if old else {}):
+                raise _error("ConditionalCheckFailedException", "DeleteItem", "The conditional request failed")
+            self.items.pop(_key_identity(key), None)
+        response = {}
+        returned = self._return_values(ReturnValues, old, None)
+        if returned is not None:
+            response["Attributes"] = copy.deepcopy(returned)
+        return self._capacity(response, kwargs, item_size(old) if old else 0, write=True)
+
+    def get_item(self, **kwargs):
+        self.backend._simulate("GetItem")
+        return self._get_item(**kwargs)
+
+    def put_item(self, **kwargs):
+        self.backend._simulate("PutItem")
+        return self._put_item(**kwargs)
+
+    def update_item(self, **kwargs):
+        self.backend._simulate("UpdateItem")
+        return self._update_item(**kwargs)
+
+    def delete_item(self, **kwargs):
+        self.backend._simulate("DeleteItem")
+        return self._delete_item(**kwargs)
+
+    def _index_keys(self, index_name):
+        if not index_name:
+            return self.key_schema.hash_key, self.key_schema.range_key
+        if index_name not in self.key_schema.indexes:
+            raise _error("ValidationException", "Query", "The table does not have the specified index: {}".format(index_name))
+        return self.key_schema.indexes[index_name]
+
+    def _order_key(self, item, range_key):
+        table_key = tuple(_orderable(item.get(k)) for k in self.key_schema.key_names)
+        if range_key:
+            return (_orderable(item.get(range_key)),) + table_key
+        return table_key
+
+    def _search(self, operation, candidates, index_name=None, ExclusiveStartKey=None, FilterExpression=None, Limit=None, ScanIndexForward=True, Select=None, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False, **kwargs):
+        hash_key, range_key = self._index_keys(index_name)
+        order_range = range_key if operation == "Query" else None
+        candidates = [item for item in candidates if hash_key in item and (not range_key or range_key in item)]
+        candidates.sort(key=lambda item: self._order_key(item, order_range), reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = self._order_key(_normalize_item(ExclusiveStartKey), order_range)
+            if ScanIndexForward:
+                candidates = [item for item in candidates if self._order_key(item, order_range) > start]
+            else:
+                candidates = [item for item in candidates if self._order_key(item, order_range) < start]
+        page = []
+        scanned = 0
+        size = 0
+        last_key = None
+        for position, item in enumerate(candidates):
+            scanned += 1
+            size += item_size(item)
+            if evaluate_condition(FilterExpression, item):
+                page.append(item)
+            if (Limit and scanned >= Limit) or size >= self.backend.page_size:
+                if position + 1 < len(candidates):
+                    last_key = {k:item[k] for k in set(self.key_schema.key_names + tuple(k for k in (hash_key, range_key) if k))}
+                break
+        response = {"Count":len(page), "ScannedCount":scanned}
+        if Select != "COUNT":
+            if ProjectionExpression:
+                paths = _ExpressionParser(ProjectionExpression, ExpressionAttributeNames).paths()
+                page = [_project(item, paths) for item in page]
+            response["Items"] = copy.deepcopy(page)
+        if last_key:
+            response["LastEvaluatedKey"] = copy.deepcopy(last_key)
+        return self._capacity(response, kwargs, size, consistent=ConsistentRead)
+
+    def query(self, KeyConditionExpression=None, IndexName=None, **kwargs):
+        self.backend._simulate("Query")
+        if KeyConditionExpression is None:
+            raise _error("ValidationException", "Query", "Either the KeyConditions or KeyConditionExpression parameter must be specified in the request.")
+        with self.backend._lock:
+            candidates = [item for item in self.items.values() if evaluate_condition(KeyConditionExpression, item)]
+        return self._search("Query", candidates, index_name=IndexName, **kwargs)
+
+    def scan(self, IndexName=None, Segment=None, TotalSegments=None, **kwargs):
+        self.backend._simulate("Scan")
+        with self.backend._lock:
+            candidates = list(self.items.values())
+        if TotalSegments:
+            hash_key = self._index_keys(IndexName)[0]
+            candidates = [item for item in candidates if hash_key in item and zlib.crc32(repr(item[hash_key]).encode("utf-8")) % TotalSegments == Segment]
+        return self._search("Scan", candidates, index_name=IndexName, **kwargs)
+
+class MemoryBackend(object):
+    '''
+    Backend (see toco.backend) that keeps its tables in memory.
+
+    :param latency: Seconds to sleep on every call, to simulate network round trips.
+    :param throttle_rate: Probability (0-1) that a call is throttled.  Single-item calls raise ProvisionedThroughputExceededException; batch calls return the affected keys/items as unprocessed.
+    :param page_size: How many bytes of items a query or scan evaluates before returning a page.
+    :param seed: Seed for the throttling random number generator, for reproducible runs.
+    '''
+    def __init__(self, latency=0, throttle_rate=0, page_size=PAGE_SIZE, seed=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.page_size = page_size
+        self.tables = {}
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    def _throttled(self):
+        if not self.throttle_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.throttle_rate
+
+    def _simulate(self, operation, batch=False):
+        if self.latency:
+            time.sleep(self.latency)
+        if not batch and self._throttled():
+            raise _error("ProvisionedThroughputExceededException", operation, "Rate of requests exceeds the allowed throughput.")
+
+    def create_table(self, **schema):
+        with self._lock:
+            if schema["TableName"] in self.tables:
+                raise _error("ResourceInUseException", "CreateTable", "Table already exists: {}".format(schema["TableName"]))
+            self.tables[schema["TableName"]] = MemoryTable(self, schema)
+        return {"TableDescription":{"TableName":schema["TableName"], "TableStatus":"ACTIVE"}}
+
+    def Table(self, name):
+        if name not in self.tables:
+            raise _error("ResourceNotFoundException", "DescribeTable", "Requested resource not found: Table: {} not found".format(name))
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity="NONE"):
+        self._simulate("BatchGetItem", batch=True)
+        if sum(len(request["Keys"]) for request in RequestItems.values()) > 100:
+            raise _error("ValidationException", "BatchGetItem", "Too many items requested for the BatchGetItem call")
+        responses = {}
+        unprocessed = {}
+        capacity = []
+        for table_name, request in RequestItems.items():
+            table = self.Table(table_name)
+            identities = [_key_identity(table._key(key, "BatchGetItem")) for key in request["Keys"]]
+            if len(set(identities)) != len(identities):
+                raise _error("ValidationException", "BatchGetItem", "Provided list of item keys contains duplicates")
+            responses[table_name] = []
+            for key in request["Keys"]:
+                if self._throttled():
+                    unprocessed.setdefault(table_name, dict(request, Keys=[]))["Keys"].append(key)
+                    continue
+                params = {k:request[k] for k in ("ProjectionExpression", "ExpressionAttributeNames", "ConsistentRead") if k in request}
+                response = table._get_item(Key=key, ReturnConsumedCapacity=ReturnConsumedCapacity, **params)
+                if "Item" in response:
+                    responses[table_name].append(response["Item"])
+                if "ConsumedCapacity" in response:
+                    capacity.append(response["ConsumedCapacity"])
+        response = {"Responses":responses, "UnprocessedKeys":unprocessed}
+        if capacity:
+            response["ConsumedCapacity"] = capacity
+        return response
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity="NONE"):
+        self._simulate("BatchWriteItem", batch=True)
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise _error("ValidationException", "BatchWriteItem", "Too many items requested for the BatchWriteItem call")
+        unprocessed = {}
+        capacity = []
+        for table_name, requests in RequestItems.items():
+            table = self.Table(table_name)
+            identities = []
+            for request in requests:
+                key = request["PutRequest"]["Item"] if "PutRequest" in request else request["DeleteRequest"]["Key"]
+                identities.append(_key_identity(table._key(key, "BatchWriteItem")))
+            if len(set(identities)) != len(identities):
+                raise _error("ValidationException", "BatchWriteItem", "Provided list of item keys contains duplicates")
+            for request in requests:
+                if self._throttled():
+                    unprocessed.setdefault(table_name, []).append(request)
+                elif "PutRequest" in request:
+                    response = table._put_item(Item=request["PutRequest"]["Item"], ReturnConsumedCapacity=ReturnConsumedCapacity)
+                    capacity.append(response.get("ConsumedCapacity"))
+                else:
+                    response = table._delete_item(Key=request["DeleteRequest"]["Key"], ReturnConsumedCapacity=ReturnConsumedCapacity)
+                    capacity.append(response.get("ConsumedCapacity"))
+        response = {"UnprocessedItems":unprocessed}
+        capacity = [c for c in capacity if c]
+        if capacity:
+            response["ConsumedCapacity"] = capacity
+        return response
+
+    def _transact_tables(self, transact_items, operation):
+        if len(transact_items) > 100:
+            raise _error("ValidationException", operation, "Member must have length less than or equal to 100")
+        requests = []
+        identities = set()
+        for transact_item in transact_items:
+            (action, request), = transact_item.items()
+            table = self.Table(request["TableName"])
+            identity = (table.name, _key_identity(table._key(request["Item"] if action == "Put" else request["Key"], operation)))
+            if identity in identities:
+                raise _error("ValidationException", operation, "Transaction request cannot include multiple operations on one item")
+            identities.add(identity)
+            requests.append((action, request, table))
+        return requests
+
+    def transact_write_items(self, TransactItems, ReturnConsumedCapacity="NONE", ClientRequestToken=None):
+        '''
+        Apply every put, update, delete and condition check in TransactItems, or none of them.
+
+        A failed condition raises TransactionCanceledException, with one CancellationReasons entry per item as DynamoDB gives.
+        '''
+        self._simulate("TransactWriteItems")
+        requests = self._transact_tables(TransactItems, "TransactWriteItems")
+        capacity = []
+        with self._lock:
+            reasons = []
+            for action, request, table in requests:
+                key = table._key(request["Item"] if action == "Put" else request["Key"], "TransactWriteItems")
+                current = table.items.get(_key_identity(key))
+                if evaluate_condition(request.get("ConditionExpression"), current if current else {}):
+                    reasons.append({"Code":"None"})
+                else:
+                    reasons.append({"Code":"ConditionalCheckFailed", "Message":"The conditional request failed"})
+            if any(reason["Code"] != "None" for reason in reasons):
+                raise ClientError({"Error":{"Code":"TransactionCanceledException", "Message":"Transaction cancelled, please refer cancellation reasons for specific reasons [{}]".format(", ".join(reason["Code"] for reason in reasons))}, "CancellationReasons":reasons}, "TransactWriteItems")
+            snapshot = {table.name:dict(table.items) for action, request, table in requests}
+            try:
+                for action, request, table in requests:
+                    params = {k:v for k, v in request.items() if k not in ("TableName", "ConditionExpression")}
+                    if action == "Put":
+                        response = table._put_item(ReturnConsumedCapacity=ReturnConsumedCapacity, **params)
+                    elif action == "Update":
+                        response = table._update_item(ReturnConsumedCapacity=ReturnConsumedCapacity, **params)
+                    elif action == "Delete":
+                        response = table._delete_item(ReturnConsumedCapacity=ReturnConsumedCapacity, **params)
+                    else:
+                        continue
+                    capacity.append(response.get("ConsumedCapacity"))
+            except Exception as e:
+                for action, request, table in requests:
+                    table.items = snapshot[table.name]
+                raise e
+        response = {}
+        capacity = [c for c in capacity if c]
+        if capacity:
+            response["ConsumedCapacity"] = capacity
+        return response
+
+    def transact_get_items(self, TransactItems, ReturnConsumedCapacity="NONE"):
+        self._simulate("TransactGetItems")
+        requests = self._transact_tables(TransactItems, "TransactGetItems")
+        responses = []
+        capacity = []
+        with self._lock:
+            for action, request, table in requests:
+                params = {k:v for k, v in request.items() if k != "TableName"}
+                response = table._get_item(ReturnConsumedCapacity=ReturnConsumedCapacity, ConsistentRead=True, **params)
+                responses.append({"Item":response["Item"]} if "Item" in response else {})
+                capacity.append(response.get("ConsumedCapacity"))
+        response = {"Responses":responses}
+        capacity = [c for c in capacity if c]
+        if capacity:
+            response["ConsumedCapacity"] = capacity
+        return response
@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 
 import base64
-from botocore.exceptions import *
-from boto3.dynamodb.conditions import Key, Attr, Or
-from boto3.dynamodb.types import TypeSerializer
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 import copy
 from datetime import datetime
 import decimal
+import functools
 import inspect
 import json
 import logging
 import os
+import queue
+import random
+import threading
+import time
 import traceback
 
+from .backend import get_backend
+from .cache import ObjectCache
+from . import cfcache
+from . import config
+from .session import current_session
+from . import aio
+from . import instrumentation
+
 VERSION_KEY = 'version_toco_'
 
 JSON_CLASS = '_class_toco'
@@ -27,6 +37,22 @@ CONSTANT_FKEYS = {FKEY_EMPTY_STRING: ""}
 
 DATETIME_FORMAT = "datetime:%Y-%m-%dT%H:%M:%S.%fZ"
 
+# Service limits for the batch APIs, plus how hard to retry unprocessed keys/items.
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+BATCH_MAX_ATTEMPTS = 8
+BATCH_BACKOFF_BASE = 0.05
+BATCH_BACKOFF_CAP = 5.0
+
+# How many distinct foreign key strings to keep parsed in memory.
+FKEY_PARSE_CACHE_SIZE = 4096
+
+# Default parallel_scan workers per CPU, for thread and process pools respectively.
+SCAN_THREADS_PER_CPU = 4
+SCAN_PROCESSES_PER_CPU = 1
+# How often (in seconds) parallel_scan checks on its workers while waiting for results.
+SCAN_POLL_INTERVAL = 1.0
+
 logger = logging.getLogger(__name__)
 
 def load_python_class_if_applicable(value):
@@ -37,9 +63,10 @@ def load_python_class_if_applicable(value):
             pass
     return value
 
+@functools.lru_cache(maxsize=None)
 def get_class(clazzname):
     '''
-    Dynamically retrieve a class from its name.
+    Dynamically retrieve a class from its name.  Results are cached, as this is called on every foreign key dereference.
 
     (From http://stackoverflow.com/questions/547829/how-to-dynamically-load-a-python-class)
 
@@ -63,16 +90,9 @@ def is_foreign_key(fkey):
         return False
     if fkey in CONSTANT_FKEYS:
         return True
-    try:
-        obj = json.loads(fkey[len(FKEY_PREFIX):])
-        obj['class']
-        obj['key']
-        return True
-    except:
-        # If the above throws an exception, we know it isn't a valid foreign key
-        # We might want to raise an exception instead if it has the fkey prefix but isn't valid,
-        # but I'll add that later if it looks useful.
-        return False
+    # We might want to raise an exception instead if it has the fkey prefix but isn't valid,
+    # but I'll add that later if it looks useful.
+    return _parse_fkey(fkey) is not None
 
 def load_from_fkey(fkey, **kwargs):
     '''
@@ -85,17 +105,103 @@ def load_from_fkey(fkey, **kwargs):
         return None
     if fkey in CONSTANT_FKEYS:
         return CONSTANT_FKEYS[fkey]
-    obj = json.loads(fkey[len(FKEY_PREFIX):])
-    key = obj['key']
-    clazzname = obj['class']
-    del obj['key']
-    del obj['class']
+    clazzname, key, extras = _parse_fkey(fkey)
+    obj = dict(extras)
     obj.update(key)
     obj.update(**kwargs)
     return get_class(clazzname)._from_fkey(**obj)
 
+@functools.lru_cache(maxsize=FKEY_PARSE_CACHE_SIZE)
+def _parse_fkey(fkey):
+    '''
+    Split a toco foreign key into the name of its class, its key dict, and any other parameters needed to load it.
+
+    Results are cached and shared, so callers must treat the returned dicts as read-only.
+
+    :param fkey: A (non-constant) toco foreign key.
+    :rtype: tuple of (classname, key, extras), or None if fkey isn't a valid foreign key
+    '''
+    try:
+        obj = json.loads(fkey[len(FKEY_PREFIX):])
+        key = obj.pop('key')
+        clazzname = obj.pop('class')
+    except:
+        # If the above throws an exception, we know it isn't a valid foreign key
+        return None
+    return clazzname, key, obj
+
+def prefetch_related(objs, paths):
+    '''
+    Resolve the foreign keys at the given attribute paths for all of the given objects up front, so that accessing those attributes later doesn't hit DynamoDB.
+
+    Each level of the paths is fetched with as few BatchGetItem calls as possible, grouped across classes and tables.
+
+    :param objs: Iterable of toco objects (Nones are skipped).
+    :param paths: Attribute names, or dotted paths like "owner.org" to follow foreign keys of the related objects.
+    '''
+    tree = {}
+    for path in paths:
+        node = tree
+        for part in path.split("."):
+            node = node.setdefault(part, {})
+    _prefetch_level([obj for obj in objs if obj is not None], tree)
+
+def _prefetch_level(objs, tree):
+    groups = {}
+    refs = []
+    for obj in objs:
+        if obj._needs_reloaded:
+            obj._reload()
+            obj._needs_reloaded = False
+        for attr in tree:
+            value = obj._item_view().get(attr)
+            if attr in obj._fkey_cache or not is_foreign_key(value) or value in CONSTANT_FKEYS:
+                continue
+            clazzname, key, extras = _parse_fkey(value)
+            group = groups.setdefault((clazzname, json.dumps(extras, sort_keys=True)), {"class":None, "keys":{}})
+            if not group["class"]:
+                group["class"] = get_class(clazzname)._class_for_fkey(**extras)
+            existing = group["class"]._session_get(key)
+            if existing is not None and existing._in_db and not existing._needs_reloaded:
+                obj._fkey_cache[attr] = existing
+                continue
+            group["keys"][value] = key
+            refs.append((obj, attr, value))
+    if groups:
+        # Related classes can use different backends, so each backend gets its own batch gets (as in toco.fanout.gather).
+        by_backend = {}
+        for group in groups.values():
+            wanted = by_backend.setdefault(id(group["class"].RESOURCE()), {"class":group["class"], "keys":{}})
+            wanted["keys"].setdefault(group["class"].TABLE_NAME(), []).extend(group["keys"].values())
+        items_by_table = {}
+        for backend_id, wanted in by_backend.items():
+            for table_name, items in batch_get_items(wanted["class"], wanted["keys"]).items():
+                items_by_table[(backend_id, table_name)] = items
+        fetched = {}
+        for group in groups.values():
+            clazz = group["class"]
+            items = {_key_identity(clazz._key_from_dict(item)):item for item in items_by_table[(id(clazz.RESOURCE()), clazz.TABLE_NAME())]}
+            for fkey, key in group["keys"].items():
+                item = items.get(_key_identity(clazz._key_from_dict(key)))
+                if item is not None:
+                    fetched[fkey] = clazz._from_item(item)
+        for obj, attr, fkey in refs:
+            if fkey in fetched:
+                obj._fkey_cache[attr] = fetched[fkey]
+    for attr in tree:
+        if tree[attr]:
+            related = {}
+            for obj in objs:
+                value = obj._fkey_cache.get(attr)
+                if isinstance(value, TocoObject):
+                    related[id(value)] = value
+            _prefetch_level(list(related.values()), tree[attr])
+
+# Table name -> the ObjectCache shared by the classes on that table (see BaseTocoObject.OBJECT_CACHE).
+_OBJECT_CACHES = {}
+_OBJECT_CACHES_LOCK = threading.Lock()
+
 def ensure_ddbsafe(d):
-    ts = TypeSerializer()
     if isinstance(d, str):
         if len(d) == 0:
             return FKEY_EMPTY_STRING
@@ -122,57 +228,309 @@ def load_constant_fkeys(d):
     else:
         return d
 
+def _json_number(value):
+    # DynamoDB hands numbers back as Decimals, which json can't serialize on its own.
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(value.__class__.__name__))
+
+def _key_identity(key):
+    '''
+    Hashable representation of a key dict, for matching batch responses back up with requests.
+    '''
+    return tuple(sorted(key.items()))
+
+def _backoff_delay(attempt):
+    '''
+    Exponential backoff with full jitter, in seconds, for the given (zero-indexed) retry attempt.
+    '''
+    return random.uniform(0, min(BATCH_BACKOFF_CAP, BATCH_BACKOFF_BASE * (2 ** attempt)))
+
+def _record_retry(clazz, operation):
+    active = instrumentation.get_instrumentation()
+    if active:
+        active.record_retry(clazz.CLASS_NAME(), operation)
+
+def batch_get_items(clazz, keys_by_table, consistent_read=False, projections=None, max_workers=1):
+    '''
+    Fetch items from one or more tables using BatchGetItem.
+
+    Keys are deduplicated and split into chunks of BATCH_GET_LIMIT (across all tables), and any UnprocessedKeys are retried with backoff.
+
+    :param clazz: The toco class whose backend the requests are issued against (and which they're recorded against when instrumented).
+    :param keys_by_table: Dict mapping table names to lists of key dicts.
+    :param consistent_read: Whether to use strongly consistent reads.
+    :param projections: Dict mapping table names to ProjectionExpression/ExpressionAttributeNames params for that table (see BaseTocoObject._projection_params).
+    :param max_workers: How many chunks to have in flight at once, on a thread pool if more than 1.
+    :rtype: Dict mapping table names to lists of the items found, in no particular order.
+    '''
+    projections = projections if projections else {}
+    pending = []
+    seen = set()
+    for table_name in keys_by_table:
+        for key in keys_by_table[table_name]:
+            identity = (table_name, _key_identity(key))
+            if identity not in seen:
+                seen.add(identity)
+                pending.append((table_name, key))
+    chunks = []
+    for start in range(0, len(pending), BATCH_GET_LIMIT):
+        request_items = {}
+        for table_name, key in pending[start:start+BATCH_GET_LIMIT]:
+            request_items.setdefault(table_name, dict(projections.get(table_name, {}), Keys=[], ConsistentRead=consistent_read))["Keys"].append(key)
+        chunks.append(request_items)
+    found = {table_name:[] for table_name in keys_by_table}
+    if max_workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            results = list(executor.map(functools.partial(_batch_get_chunk, clazz), chunks))
+    else:
+        results = [_batch_get_chunk(clazz, request_items) for request_items in chunks]
+    for responses in results:
+        for table_name, items in responses.items():
+            found.setdefault(table_name, []).extend(items)
+    return found
+
+def _batch_get_chunk(clazz, request_items):
+    found = {}
+    attempt = 0
+    while request_items:
+        response = clazz._call_resource("batch_get_item", RequestItems=request_items)
+        for table_name, items in response.get("Responses", {}).items():
+            found.setdefault(table_name, []).extend(items)
+        request_items = response.get("UnprocessedKeys", None)
+        if request_items:
+            if attempt >= BATCH_MAX_ATTEMPTS:
+                raise RuntimeError("Unable to process all keys after {} attempts.".format(attempt+1))
+            _record_retry(clazz, "batch_get_item")
+            time.sleep(_backoff_delay(attempt))
+            attempt += 1
+    return found
+
+class _ScanStopped(Exception):
+    pass
+
+def _put_until_stopped(out_queue, stop, message):
+    # Block on the bounded queue, but give up if the consumer has gone away.
+    while True:
+        try:
+            out_queue.put(message, timeout=0.1)
+            return
+        except queue.Full:
+            if stop.is_set():
+                raise _ScanStopped()
+
+def _scan_segment(clazz, params, segment, total_segments, start_token, callback, raw, out_queue, stop):
+    '''
+    Worker for BaseTocoObject.parallel_scan.  Lives at module level so that it can be run in a process pool.
+    '''
+    params = dict(params, Segment=segment, TotalSegments=total_segments)
+    try:
+        if start_token:
+            params["ExclusiveStartKey"] = clazz._decode_nexttoken(start_token)
+        while not stop.is_set():
+            results = clazz._call_table("scan", **params)
+            items = results.get("Items", [])
+            for item in items:
+                if raw and not callback:
+                    value = item
+                else:
+                    value = clazz._from_item(item)
+                    if callback:
+                        value = callback(value)
+                _put_until_stopped(out_queue, stop, ("item", value))
+            last_key = results.get("LastEvaluatedKey", None)
+            token = clazz._encode_nexttoken(last_key) if last_key else None
+            _put_until_stopped(out_queue, stop, ("progress", segment, token, len(items)))
+            if not last_key:
+                return
+            params["ExclusiveStartKey"] = last_key
+    except _ScanStopped:
+        pass
+    except Exception as e:
+        try:
+            _put_until_stopped(out_queue, stop, ("error", segment, e))
+        except _ScanStopped:
+            pass
+
 class blob(dict):
-    RESERVED_KEYS = ["__predefined_attributes__","__raise_on_miss","_blob__raise_on_miss"]
-    def __init__(self, *args, **kwargs):
-        __raise_on_miss = bool(kwargs.get("raise_on_miss"))
-        if "raise_on_miss" in kwargs:
-            del kwargs["raise_on_miss"]
+    '''
+    A dict whose items can also be read, written and deleted as attributes.
+
+    Attribute reads fall back to the items (through __getattr__), so real attributes of the class, like the dict methods,
+    take precedence over items with the same name.  Reading an attribute that isn't an item gives None, or raises
+    AttributeError if the blob was created with raise_on_miss=True.
+
+    Every item is stored once, in the dict itself; nothing is mirrored into instance attributes.
+    '''
+    __slots__ = ("__raise_on_miss",)
+    # Names that are the blob's own attributes rather than items.
+    RESERVED_KEYS = frozenset(["_blob__raise_on_miss"])
+
+    def __init__(self, *args, raise_on_miss=False, **kwargs):
         super().__init__(*args, **kwargs)
-        self.__predefined_attributes__ = [a for a in dir(self)]
-        self.__predefined_attributes__.append("__predefined_attributes__")
-        self.__raise_on_miss = __raise_on_miss
-        self.__predefined_attributes__.append("__raise_on_miss")
-        for key in self.keys():
-            if not key in self.__predefined_attributes__:
-                setattr(self, key, self[key])
-                pass
-            pass
-        pass
+        object.__setattr__(self, "_blob__raise_on_miss", bool(raise_on_miss))
+
+    def __getattr__(self, name):
+        # Only called once normal attribute lookup has failed.
+        if name in self:
+            return self[name]
+        if name in blob.RESERVED_KEYS or (name.startswith("__") and name.endswith("__")):
+            # Protocol lookups (copy, pickle etc) and a not-yet-restored flag must look missing, not be treated as items.
+            raise AttributeError(name)
+        if object.__getattribute__(self, "_blob__raise_on_miss"):
+            raise AttributeError("blob has no item or attribute {}".format(name))
+        return None
 
     def __setattr__(self, name, value):
-        object.__setattr__(self, name, value)
-        if name not in blob.RESERVED_KEYS:
-            self.__setitem__(name, value)
+        if name in blob.RESERVED_KEYS:
+            object.__setattr__(self, name, value)
+        else:
+            self[name] = value
 
-    def __getattribute__(self, name):
-        try:
-            return object.__getattribute__(self, name)
-        except:
-            if object.__getattribute__(self, "__raise_on_miss"):
-                return self.__getitem__(name)
-            else:
-                return self.get(name)
+    def __delattr__(self, name):
+        if name in blob.RESERVED_KEYS:
+            object.__delattr__(self, name)
+        elif name in self:
+            del self[name]
+        else:
+            raise AttributeError(name)
+
+def _hash_and_range_names(key_schema):
+    hash = [h['AttributeName'] for h in key_schema if h['KeyType']=='HASH'][0]
+    ranges = [r['AttributeName'] for r in key_schema if r['KeyType']=='RANGE']
+    range = ranges[0] if ranges else None
+    return hash, range
 
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        if not key in self.__predefined_attributes__:
-            object.__setattr__(self, key, self[key])
+class KeySchema(object):
+    '''
+    The parts of a table schema that get consulted on every construction, save, delete and query, pulled out of the full schema once per class.
+
+    :param schema: A dict that can be passed to client.create_table(**schema).
+    :param required_attributes: Non-key attributes that must be present before saving.
+    '''
+    def __init__(self, schema, required_attributes=()):
+        self.table_name = schema.get('TableName')
+        self.hash_key, self.range_key = _hash_and_range_names(schema['KeySchema'])
+        self.key_names = tuple(k for k in (self.hash_key, self.range_key) if k)
+        self.indexes = {}
+        for index in schema.get("GlobalSecondaryIndexes", []) + schema.get("LocalSecondaryIndexes", []):
+            self.indexes[index["IndexName"]] = _hash_and_range_names(index["KeySchema"])
+        self.attribute_types = {a['AttributeName']:a['AttributeType'] for a in schema.get("AttributeDefinitions", [])}
+        self.required_attributes = self.key_names + tuple(required_attributes)
+
+    def hash_and_range(self, index_name=None):
+        if not index_name:
+            return self.hash_key, self.range_key
+        if index_name not in self.indexes:
+            raise RuntimeError("No index with the name '{index_name}' found!".format(index_name=index_name))
+        return self.indexes[index_name]
+
+class UpdateExpression(object):
+    '''
+    Accumulates the clauses of a DynamoDB UpdateExpression, along with its placeholder names and values.
+
+    Placeholders use their own prefixes so they can't collide with the ones boto3 generates for condition objects in the same request.
+    '''
+    def __init__(self):
+        self._clauses = {"SET":[], "REMOVE":[], "ADD":[], "DELETE":[]}
+        self._names = {}
+        self._values = {}
 
-    def __delitem__(self, key):
-        super().__delitem__(key)
-        if not key in self.__predefined_attributes__:
-            delattr(self, key)
+    def __bool__(self):
+        return any(self._clauses.values())
+
+    def name(self, attrname):
+        for placeholder in self._names:
+            if self._names[placeholder] == attrname:
+                return placeholder
+        placeholder = "#u{}".format(len(self._names))
+        self._names[placeholder] = attrname
+        return placeholder
+
+    def value(self, value):
+        placeholder = ":u{}".format(len(self._values))
+        self._values[placeholder] = value
+        return placeholder
+
+    def set(self, attrname, value):
+        self._clauses["SET"].append("{} = {}".format(self.name(attrname), self.value(value)))
+
+    def remove(self, attrname):
+        self._clauses["REMOVE"].append(self.name(attrname))
+
+    def add(self, attrname, value):
+        self._clauses["ADD"].append("{} {}".format(self.name(attrname), self.value(value)))
+
+    def delete(self, attrname, value):
+        self._clauses["DELETE"].append("{} {}".format(self.name(attrname), self.value(value)))
+
+    def append(self, attrname, values):
+        name = self.name(attrname)
+        self._clauses["SET"].append("{name} = list_append(if_not_exists({name}, {empty}), {values})".format(name=name, empty=self.value([]), values=self.value(list(values))))
+
+    def params(self):
+        '''
+        :rtype: Dict of UpdateExpression, ExpressionAttributeNames and (if needed) ExpressionAttributeValues, to pass to update_item.
+        '''
+        params = {
+            "UpdateExpression":" ".join("{} {}".format(action, ", ".join(self._clauses[action])) for action in ("SET", "REMOVE", "ADD", "DELETE") if self._clauses[action]),
+            "ExpressionAttributeNames":dict(self._names),
+        }
+        if self._values:
+            params["ExpressionAttributeValues"] = dict(self._values)
+        return params
 
 class BaseTocoObject(object):
     """
     Holder class for a bunch of class methods and stuff like that.
     """
+    __slots__ = ()
     _SCHEMA_CACHE = None
-    _TABLE_CACHE = None
+    _KEY_SCHEMA_CACHE = None
+    # Set this to use a specific backend for this class (and its subclasses) instead of the default one.
+    _BACKEND = None
     _CLASSNAME = None
     _REQUIRED_ATTRS = []
     _COMPOUND_ATTRS = {}
+    # If true, saves of objects already in the DB send only the changed attributes with UpdateItem.
+    _DELTA_SAVES = False
+    # Set _CACHE_SIZE to enable a read-through cache of this many items (see toco.cache), expiring after _CACHE_TTL seconds if set.
+    _CACHE_SIZE = 0
+    _CACHE_TTL = None
+    # If true, objects built from query/scan/batch results keep the raw item and only decode attributes as they're read.
+    _LAZY_LOAD = False
+    # What reading an attribute that a fields=[...] load left out does: "fetch" it with a GetItem, or "raise" AttributeError.
+    _PARTIAL_MISS = "fetch"
+    # Optional declared types for attributes, as {name: toco.fields.Field}.  Merged with any declared by base classes.
+    _FIELDS = {}
+
+    @classmethod
+    def _field_codecs(cls):
+        '''
+        :rtype: Dict of attribute name to the Field that encodes/decodes it, for every field declared by this class and its bases.  Built once per class.
+        '''
+        codecs = cls.__dict__.get("_FIELD_CODECS", None)
+        if codecs is None:
+            codecs = {}
+            for clazz in reversed(cls.__mro__):
+                codecs.update(clazz.__dict__.get("_FIELDS", {}))
+            cls._FIELD_CODECS = codecs
+        return codecs
+
+    @classmethod
+    def _encode_attr(cls, name, value):
+        '''
+        :rtype: value as it should be sent to DynamoDB, using the field declared for name if there is one.
+        '''
+        field = cls._field_codecs().get(name)
+        return ensure_ddbsafe(value) if field is None else field.encode(value)
+
+    @classmethod
+    def _encode_item(cls, d):
+        codecs = cls._field_codecs()
+        if not codecs:
+            return ensure_ddbsafe(d)
+        return {k:(ensure_ddbsafe(v) if k not in codecs else codecs[k].encode(v)) for k, v in d.items()}
 
     @classmethod
     def _from_dict(cls, d):
@@ -186,8 +544,8 @@ class BaseTocoObject(object):
     def _encode_nexttoken(cls, key):
         # TODO: replace the json step with something that'll work for any input
         # Convert to a string
-        # This won't work for a lot of valid keys due to the json serialization step
-        key = json.dumps(key)
+        # This won't work for binary keys due to the json serialization step
+        key = json.dumps(key, default=_json_number)
         # base64 encode it to make it safer to handle
         key = base64.urlsafe_b64encode(key.encode("utf-8")).decode("utf-8")
         # strip the padding, as we can easily re-add it later
@@ -202,19 +560,72 @@ class BaseTocoObject(object):
         # convert if back from base64-encoded bytes to the underlying string
         key = base64.urlsafe_b64decode(key.encode("utf-8")).decode("utf-8")
         # load the string back into a dict
-        # This won't work for a lot of valid keys due to the json serialization step
-        key = json.loads(key)
+        # This won't work for binary keys due to the json serialization step
+        key = json.loads(key, parse_float=decimal.Decimal)
         return key
 
     @classmethod
-    def _parse_items(cls, response):
-        items = []
-        for item in response.get("Items",[]):
+    def _from_item(cls, item, lazy=None, fields=None):
+        '''
+        Build an object from an item read from DynamoDB.
+
+        :param lazy: Keep the item as-is and decode attributes on access (see TocoObject._from_raw_item).  Defaults to the class's _LAZY_LOAD.
+        :param fields: The fields the item was projected down to, if it was; the object is then marked as partial.
+        '''
+        session = current_session()
+        if session is not None:
+            existing = session.get(cls, item)
+            if existing is not None:
+                if existing._needs_reloaded:
+                    # A foreign key placeholder that hasn't been read yet; this item is what it would have read.
+                    existing._needs_reloaded = False
+                    existing._update_attrs(**item)
+                    existing._clear_update_record()
+                    existing._in_db = True
+                return existing
+        if cls._LAZY_LOAD if lazy is None else lazy:
+            obj = cls._from_raw_item(item)
+        else:
             params = dict(item)
             params["_in_db"] = True
             params["_attempt_load"] = False
-            items.append(cls(**params))
-        return items
+            obj = cls(**params)
+            # The object matches what's in the DB, so nothing about it is an unsaved change.
+            obj._clear_update_record()
+        obj._loaded_fields = cls._loaded_fields_for(fields)
+        return session.add(obj) if session is not None else obj
+
+    @classmethod
+    def _parse_items(cls, response, lazy=None, fields=None):
+        return [cls._from_item(item, lazy=lazy, fields=fields) for item in response.get("Items",[])]
+
+    @classmethod
+    def _loaded_fields_for(cls, fields):
+        '''
+        :rtype: frozenset of the attributes a fields=[...] read fetches (the key attributes and VERSION_KEY are always included), or None if fields is None.
+        '''
+        if fields is None:
+            return None
+        return frozenset(fields) | frozenset(cls.KEY_SCHEMA().key_names) | frozenset([VERSION_KEY])
+
+    @classmethod
+    def _projection_params(cls, fields, params=None):
+        '''
+        Add a ProjectionExpression for fields to params.  Every name is escaped through ExpressionAttributeNames, so reserved words are fine.
+
+        :rtype: dict of the new params
+        '''
+        params = dict(params) if params else {}
+        if fields is None:
+            return params
+        names = dict(params.get("ExpressionAttributeNames", {}))
+        placeholders = []
+        for i, name in enumerate(sorted(cls._loaded_fields_for(fields))):
+            names["#f{}".format(i)] = name
+            placeholders.append("#f{}".format(i))
+        params["ProjectionExpression"] = ", ".join(placeholders)
+        params["ExpressionAttributeNames"] = names
+        return params
 
     @classmethod
     def _preprocess_search_params(cls, **kwargs):
@@ -232,13 +643,14 @@ class BaseTocoObject(object):
                 params["RangeKey"] = params[rangename]
                 del params[rangename]
             if params.get("HashKey", None) and not params.get("KeyConditionExpression", None):
+                from boto3.dynamodb.conditions import Key
                 hkc = Key(hashname).eq(params["HashKey"])
                 if params.get("RangeKey", None):
                     rk = params["RangeKey"]
                     if isinstance(rk,(list, tuple)):
                         rkc = getattr(Key(rangename),rk[0])(*rk[1:])
                     else:
-                        rkc = Key(rangename).eq(rk_arg)
+                        rkc = Key(rangename).eq(rk)
                     kce = hkc & rkc
                 else:
                     kce = hkc
@@ -250,43 +662,304 @@ class BaseTocoObject(object):
         return params
 
     @classmethod
-    def _postprocess_search_results(cls, results):
+    def _postprocess_search_results(cls, results, prefetch=None, fields=None):
         response = {
-            "Items":cls._parse_items(results),
+            "Items":cls._parse_items(results, fields=fields),
             "NextToken":None,
             "RawResponse":results
         }
+        if prefetch:
+            prefetch_related(response["Items"], prefetch)
         if results.get("LastEvaluatedKey", None):
             response["NextToken"] = cls._encode_nexttoken(results["LastEvaluatedKey"])
         return response
 
     @classmethod
-    def scan(cls, **kwargs):
-        params = cls._preprocess_search_params(**kwargs)
-        results = cls.TABLE().scan(**params)
-        return cls._postprocess_search_results(results)
+    def scan(cls, prefetch=None, fields=None, **kwargs):
+        params = cls._projection_params(fields, cls._preprocess_search_params(**kwargs))
+        results = cls._call_table("scan", **params)
+        return cls._postprocess_search_results(results, prefetch=prefetch, fields=fields)
+
+    @classmethod
+    def query(cls, prefetch=None, fields=None, **kwargs):
+        params = cls._projection_params(fields, cls._preprocess_search_params(**kwargs))
+        results = cls._call_table("query", **params)
+        return cls._postprocess_search_results(results, prefetch=prefetch, fields=fields)
+
+    @classmethod
+    def _iter_search(cls, operation, read_ahead=False, max_items=None, max_pages=None, prefetch=None, fields=None, **kwargs):
+        params = cls._projection_params(fields, cls._preprocess_search_params(**kwargs))
+        call = functools.partial(cls._call_table, operation)
+        executor = ThreadPoolExecutor(max_workers=1) if read_ahead else None
+        pending = None
+        count = 0
+        pages = 0
+        try:
+            results = call(**params)
+            while True:
+                pages += 1
+                last_key = results.get("LastEvaluatedKey", None)
+                if max_pages is not None and pages >= max_pages:
+                    last_key = None
+                if last_key and executor:
+                    # Fetch the next page while the caller works through this one.
+                    pending = executor.submit(call, **dict(params, ExclusiveStartKey=last_key))
+                if prefetch:
+                    items = cls._parse_items(results, fields=fields)
+                    prefetch_related(items, prefetch)
+                else:
+                    items = (cls._from_item(item, fields=fields) for item in results.get("Items", []))
+                for item in items:
+                    if max_items is not None and count >= max_items:
+                        return
+                    count += 1
+                    yield item
+                if not last_key:
+                    return
+                results = pending.result() if pending else call(**dict(params, ExclusiveStartKey=last_key))
+                pending = None
+        finally:
+            if pending:
+                pending.cancel()
+            if executor:
+                executor.shutdown(wait=False)
+
+    @classmethod
+    def iter_scan(cls, read_ahead=False, max_items=None, max_pages=None, prefetch=None, fields=None, **kwargs):
+        '''
+        Scan the table, transparently following LastEvaluatedKey, and yield objects one at a time.
+
+        :param read_ahead: Fetch the next page on a background thread while the current one is being consumed.
+        :param max_items: Stop after yielding this many objects.
+        :param max_pages: Stop after this many pages have been read.
+        :param prefetch: Attribute paths whose foreign keys should be resolved for each page (see prefetch_related).
+        :param fields: Only fetch these attributes (plus the keys and version); the objects are partial, as with load.
+        :param kwargs: Anything accepted by scan.
+        :rtype: generator of toco objects
+        '''
+        return cls._iter_search("scan", read_ahead=read_ahead, max_items=max_items, max_pages=max_pages, prefetch=prefetch, fields=fields, **kwargs)
 
     @classmethod
-    def query(cls, **kwargs):
+    def iter_query(cls, read_ahead=False, max_items=None, max_pages=None, prefetch=None, fields=None, **kwargs):
+        '''
+        Query the table, transparently following LastEvaluatedKey, and yield objects one at a time.
+
+        Takes the same arguments as iter_scan, plus anything accepted by query.
+
+        :rtype: generator of toco objects
+        '''
+        return cls._iter_search("query", read_ahead=read_ahead, max_items=max_items, max_pages=max_pages, prefetch=prefetch, fields=fields, **kwargs)
+
+    @classmethod
+    def aiter_scan(cls, max_items=None, max_pages=None, prefetch=None, fields=None, **kwargs):
+        '''
+        Async version of iter_scan; use with async for.  Each page is fetched on toco.aio's executor.
+
+        :rtype: async generator of toco objects
+        '''
+        return aio.iter_search(cls, "scan", max_items=max_items, max_pages=max_pages, prefetch=prefetch, fields=fields, **kwargs)
+
+    @classmethod
+    def aiter_query(cls, max_items=None, max_pages=None, prefetch=None, fields=None, **kwargs):
+        '''
+        Async version of iter_query; use with async for.  Each page is fetched on toco.aio's executor.
+
+        :rtype: async generator of toco objects
+        '''
+        return aio.iter_search(cls, "query", max_items=max_items, max_pages=max_pages, prefetch=prefetch, fields=fields, **kwargs)
+
+    @classmethod
+    def parallel_scan(cls, total_segments, workers=None, use_processes=False, callback=None, segment_tokens=None, on_progress=None, queue_size=1000, **kwargs):
+        '''
+        Scan the whole table as total_segments parallel segments, yielding results as they arrive.
+
+        Items are streamed from the workers through a bounded queue, so memory stays flat however big the table is.
+
+        To make a job resumable, record the tokens passed to on_progress and hand them back in as segment_tokens.
+
+        :param total_segments: How many segments to split the scan into.
+        :param workers: How many segments to scan at once.  Defaults to one per segment, up to SCAN_THREADS_PER_CPU (or SCAN_PROCESSES_PER_CPU) per CPU.
+        :param use_processes: Run segments in a process pool rather than a thread pool, for when per-item Python work dominates.  The class, callback and callback results must then be picklable.
+        :param callback: Function applied to each object in the worker.  If given, its return values are yielded instead of the objects.
+        :param segment_tokens: Dict of segment number to the NextToken to resume that segment from, or to None if that segment already finished.  Segments not in the dict start from the beginning.
+        :param on_progress: Called as on_progress(segment, next_token, item_count) after each page of each segment is consumed.  next_token is None once the segment is finished.
+        :param queue_size: Maximum number of results buffered between the workers and the caller.
+        :param kwargs: Anything accepted by scan (FilterExpression etc).
+        :rtype: generator of toco objects or callback results
+        '''
         params = cls._preprocess_search_params(**kwargs)
-        results = cls.TABLE().query(**params)
-        return cls._postprocess_search_results(results)
+        segment_tokens = segment_tokens if segment_tokens else {}
+        segments = [segment for segment in range(total_segments) if segment not in segment_tokens or segment_tokens[segment]]
+        if not segments:
+            return
+        if not workers:
+            per_cpu = SCAN_PROCESSES_PER_CPU if use_processes else SCAN_THREADS_PER_CPU
+            workers = min(len(segments), (os.cpu_count() or 1) * per_cpu)
+        manager = None
+        if use_processes:
+            # Only imported when needed, as multiprocessing is slow to import.
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            manager = multiprocessing.Manager()
+            out_queue = manager.Queue(queue_size)
+            stop = manager.Event()
+            executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            out_queue = queue.Queue(queue_size)
+            stop = threading.Event()
+            executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = [executor.submit(_scan_segment, cls, params, segment, total_segments, segment_tokens.get(segment), callback, use_processes, out_queue, stop) for segment in segments]
+            remaining = set(segments)
+            while remaining:
+                try:
+                    message = out_queue.get(timeout=SCAN_POLL_INTERVAL)
+                except queue.Empty:
+                    # Workers report their own errors through the queue, but one that couldn't even start (e.g. its
+                    # arguments couldn't be pickled, or the process pool broke) only fails its future.
+                    for future in futures:
+                        if future.done() and future.exception():
+                            raise future.exception()
+                    if all(future.done() for future in futures) and out_queue.empty():
+                        raise RuntimeError("Scan workers finished without completing segments {}.".format(sorted(remaining)))
+                    continue
+                if message[0] == "item":
+                    if use_processes and not callback:
+                        # Objects are built here rather than pickled back from the workers.
+                        yield cls._from_item(message[1])
+                    else:
+                        yield message[1]
+                elif message[0] == "progress":
+                    _, segment, token, count = message
+                    if on_progress:
+                        on_progress(segment, token, count)
+                    if not token:
+                        remaining.discard(segment)
+                else:
+                    _, segment, error = message
+                    raise error
+        finally:
+            stop.set()
+            executor.shutdown(wait=True)
+            if manager:
+                manager.shutdown()
 
     @classmethod
-    def load(cls, **kwargs):
+    def load(cls, fields=None, **kwargs):
+        '''
+        Load an object by key.  Any other kwargs are set on the loaded object as changes.
+
+        :param fields: Only fetch these attributes (plus the keys and version).  The object is marked as partial: reading any other attribute fetches it or raises, according to the class's _PARTIAL_MISS, and saves only ever update the attributes that changed.
+        :rtype: toco object, or None if there's no such item
+        '''
+        existing = cls._session_get(kwargs)
+        if existing is not None:
+            if existing._needs_reloaded:
+                existing._reload(use_cache=True)
+                existing._needs_reloaded = False
+            if existing._in_db:
+                existing._update_attrs_changed(**kwargs)
+                return existing
+            current_session().remove(existing)
+        if fields is not None:
+            key = cls._key_from_dict(kwargs)
+            item = cls._get_item(key, fields=fields)
+            if item is None:
+                return None
+            obj = cls._from_item(item, fields=fields)
+            for name in kwargs:
+                if name not in key:
+                    setattr(obj, name, kwargs[name])
+            return obj
         obj = cls(_attempt_load=True, **kwargs)
         if obj._in_db:
-            return obj
+            session = current_session()
+            return session.add(obj) if session is not None else obj
         return None
 
+    @classmethod
+    def load_many(cls, keys, consistent_read=False, prefetch=None, fields=None):
+        '''
+        Load many objects at once using BatchGetItem, rather than one GetItem per object.
+
+        :param keys: Iterable of dicts containing (at least) the hash and range keys of each object to load.
+        :param consistent_read: Whether to use strongly consistent reads.
+        :param prefetch: Attribute paths whose foreign keys should be resolved up front (see prefetch_related).
+        :param fields: Only fetch these attributes (plus the keys and version); the objects are partial, as with load.  Partial reads bypass the cache.
+        :rtype: List of toco objects in the same order as keys, with None in place of any that weren't found.
+        '''
+        key_dicts = [cls._key_from_dict(key) for key in keys]
+        cache = None if consistent_read or fields is not None else cls.OBJECT_CACHE()
+        found = {}
+        if current_session() is not None:
+            for key_dict in key_dicts:
+                existing = cls._session_get(key_dict)
+                if existing is not None and existing._in_db and not existing._needs_reloaded:
+                    found[_key_identity(key_dict)] = existing
+        if cache:
+            for key_dict in key_dicts:
+                identity = _key_identity(key_dict)
+                if identity not in found:
+                    item = cache.get(identity)
+                    if item is not None:
+                        found[identity] = cls._from_item(item)
+        table_name = cls.TABLE_NAME()
+        missing = [key_dict for key_dict in key_dicts if _key_identity(key_dict) not in found]
+        projections = {table_name:cls._projection_params(fields)} if fields is not None else None
+        items = batch_get_items(cls, {table_name:missing}, consistent_read=consistent_read, projections=projections)[table_name] if missing else []
+        for item in items:
+            identity = _key_identity(cls._key_from_dict(item))
+            if cache:
+                cache.put(identity, item)
+            found[identity] = cls._from_item(item, fields=fields)
+        objs = [found.get(_key_identity(key_dict)) for key_dict in key_dicts]
+        if prefetch:
+            prefetch_related(objs, prefetch)
+        return objs
+
+    batch_load = load_many
+
+    @classmethod
+    async def aload(cls, fields=None, **kwargs):
+        '''
+        Async version of load, run on toco.aio's executor within this class's concurrency limit.
+        '''
+        return await aio.run(cls, cls.load, fields=fields, **kwargs)
+
+    @classmethod
+    async def aload_many(cls, keys, consistent_read=False, prefetch=None, fields=None):
+        '''
+        Async version of load_many.
+        '''
+        return await aio.run(cls, cls.load_many, list(keys), consistent_read=consistent_read, prefetch=prefetch, fields=fields)
+
     @classmethod
     def SCHEMA(cls, use_cache=True):
-        if cls._SCHEMA_CACHE and use_cache:
+        # Checked in the class's own __dict__ so subclasses (e.g. from CFObject.lazysubclass) don't pick up their parent's schema.
+        if cls.__dict__.get("_SCHEMA_CACHE") and use_cache:
             return cls._SCHEMA_CACHE
         schema = cls._SCHEMA()
         cls._SCHEMA_CACHE = schema
         return schema
 
+    @classmethod
+    def KEY_SCHEMA(cls):
+        '''
+        The compiled key schema for this class, built from SCHEMA() the first time it's needed.
+
+        :rtype: KeySchema
+        '''
+        compiled = cls.__dict__.get("_KEY_SCHEMA_CACHE")
+        if not compiled:
+            compiled = KeySchema(cls.SCHEMA(), required_attributes=cls._REQUIRED_ATTRS)
+            cls._KEY_SCHEMA_CACHE = compiled
+        return compiled
+
+    @classmethod
+    def _clear_schema_cache(cls):
+        cls._SCHEMA_CACHE = None
+        cls._KEY_SCHEMA_CACHE = None
+
     @classmethod
     def _SCHEMA(cls, use_cache=True):
         raise NotImplementedError("Each subclass must implement this on their own.")
@@ -300,51 +973,145 @@ class BaseTocoObject(object):
     def CLASS_NAME(cls):
         return cls._CLASSNAME if cls._CLASSNAME else "{module}.{name}".format(module=cls.__module__, name=cls.__name__)
 
+    @classmethod
+    def RESOURCE(cls):
+        '''
+        The backend this class talks to (see toco.backend).
+        '''
+        return cls._BACKEND if cls._BACKEND else get_backend()
+
     @classmethod
     def TABLE(cls):
-        if not cls._TABLE_CACHE:
-            cls._TABLE_CACHE = boto3.resource('dynamodb').Table(cls.TABLE_NAME())
-        return cls._TABLE_CACHE
+        # Not cached here: backends keep their own Table objects, which for boto3 can't be shared between threads.
+        return cls.RESOURCE().Table(cls.TABLE_NAME())
+
+    @classmethod
+    def OBJECT_CACHE(cls):
+        '''
+        The read-through cache for this class's table, or None if this class doesn't use one (i.e. _CACHE_SIZE isn't set).
+
+        There's one cache per table, shared by every class on it (e.g. a CFObject class and the lazysubclasses its foreign keys load as), sized by the first class to use it.
+
+        :rtype: toco.cache.ObjectCache
+        '''
+        if not cls._CACHE_SIZE:
+            return None
+        table_name = cls.TABLE_NAME()
+        cache = _OBJECT_CACHES.get(table_name)
+        if cache is None:
+            with _OBJECT_CACHES_LOCK:
+                cache = _OBJECT_CACHES.setdefault(table_name, ObjectCache(cls._CACHE_SIZE, ttl=cls._CACHE_TTL, version_key=VERSION_KEY))
+        return cache
+
+    @classmethod
+    def cache_stats(cls):
+        '''
+        Hit, miss, eviction and expiration counts for this class's cache, or None if it doesn't have one.
+        '''
+        cache = cls.OBJECT_CACHE()
+        return cache.stats() if cache else None
+
+    @classmethod
+    def _get_item(cls, key, use_cache=True, fields=None):
+        '''
+        Fetch a single item by key, going through the cache if this class has one.
+
+        :param use_cache: If false, always read from DynamoDB (the result still refreshes the cache).
+        :param fields: Only fetch these attributes (plus the keys and version).  Partial items never go through the cache.
+        :rtype: The item, or None if it doesn't exist.
+        '''
+        if fields is not None:
+            return cls._call_table("get_item", Key=key, **cls._projection_params(fields)).get("Item", None)
+        cache = cls.OBJECT_CACHE()
+        identity = _key_identity(key)
+        if cache and use_cache:
+            item = cache.get(identity)
+            if item is not None:
+                return item
+        item = cls._call_table("get_item", Key=key).get("Item", None)
+        if cache and item is not None:
+            cache.put(identity, item)
+        return item
+
+    @classmethod
+    def _invalidate_cached(cls, key, version=None, inclusive=False):
+        # Writes through any class invalidate the table's cache, even if that class doesn't read from it.
+        cache = _OBJECT_CACHES.get(cls.TABLE_NAME()) if _OBJECT_CACHES else None
+        if cache:
+            cache.invalidate(_key_identity(cls._key_from_dict(key)), version=version, inclusive=inclusive)
+
+    @classmethod
+    def _call_table(cls, operation, **params):
+        '''
+        Call operation (get_item, query, etc) on this class's table, recording it if instrumentation is enabled.
+        '''
+        active = instrumentation.get_instrumentation()
+        if active:
+            return active.call(cls, operation, getattr(cls.TABLE(), operation), params)
+        return getattr(cls.TABLE(), operation)(**params)
+
+    @classmethod
+    def _call_resource(cls, operation, **params):
+        '''
+        Call a backend-level operation (batch_get_item etc), recording it if instrumentation is enabled.
+        '''
+        active = instrumentation.get_instrumentation()
+        if active:
+            return active.call(cls, operation, getattr(cls.RESOURCE(), operation), params)
+        return getattr(cls.RESOURCE(), operation)(**params)
 
     @classmethod
     def create_table(cls):
-        boto3.client("dynamodb").create_table(**cls._SCHEMA())
+        cls.RESOURCE().create_table(**cls.SCHEMA())
 
     @classmethod
     def _get_required_attributes(cls):
-        attrs = []
-        hashkn, rangekn = cls._HASH_AND_RANGE_KEYS()
-        if hashkn:
-            attrs.append(hashkn)
-        if rangekn:
-            attrs.append(rangekn)
-        attrs.extend(cls._REQUIRED_ATTRS)
-        return attrs
+        return list(cls.KEY_SCHEMA().required_attributes)
 
     @classmethod
     def _HASH_AND_RANGE_KEYS(cls, index_name=None):
-        schema = cls._SCHEMA()
-        key_schema = schema['KeySchema']
-        if index_name:
-            gsis = schema.get("GlobalSecondaryIndexes", [])
-            matches = [gsi for gsi in gsis if gsi["IndexName"] == index_name]
-            if len(matches) == 0:
-                raise RuntimeError("No index with the name '{index_name}' found!".format(index_name=index_name))
-            key_schema = matches[0]["KeySchema"]
-        hash = [h['AttributeName'] for h in key_schema if h['KeyType']=='HASH'][0]
-        ranges = [r['AttributeName'] for r in key_schema if r['KeyType']=='RANGE']
-        range = ranges[0] if ranges else None
-        return hash, range
+        return cls.KEY_SCHEMA().hash_and_range(index_name=index_name)
+
+    @classmethod
+    def _key_from_dict(cls, d):
+        return {k:d[k] for k in cls.KEY_SCHEMA().key_names if k in d}
+
+    @classmethod
+    def _identity(cls, d):
+        '''
+        :rtype: (table name, key identity) for the item described by d; what sessions key their identity maps on.
+        '''
+        return (cls.TABLE_NAME(), _key_identity(cls._key_from_dict(d)))
+
+    @classmethod
+    def _session_get(cls, d):
+        '''
+        :rtype: The active session's instance of the item described by d, or None if there's no session, no such instance, or d doesn't contain the full key.
+        '''
+        session = current_session()
+        if session is None or any(name not in d for name in cls.KEY_SCHEMA().key_names):
+            return None
+        return session.get(cls, d)
 
     @classmethod
     def _get_class_relation_map(cls, obj):
         return {'class':cls.CLASS_NAME(), 'key':obj._get_key_dict()}
 
+    @classmethod
+    def _class_for_fkey(cls, **kwargs):
+        return cls
+
     @classmethod
     def _from_fkey(cls, **kwargs):
+        existing = cls._session_get(kwargs)
+        if existing is not None:
+            return existing
+        # The object reloads itself on first access, so loading it here as well would be a wasted read.
+        kwargs.setdefault("_attempt_load", False)
         obj = cls(**kwargs)
         obj._needs_reloaded = True
-        return obj
+        session = current_session()
+        return session.add(obj) if session is not None else obj
 
     @classmethod
     def _add_compound_attr(cls, attrname, attrfunc, save=False):
@@ -355,6 +1122,11 @@ class BaseTocoObject(object):
         if attrname in cls._COMPOUND_ATTRS:
             del cls._COMPOUND_ATTRS[attrname]
 
+def _count_event(obj, event):
+    active = instrumentation.get_instrumentation()
+    if active:
+        active.count(obj.__class__.CLASS_NAME(), event)
+
 class TocoObject(BaseTocoObject):
     '''
     Base class for all DynamoDB-storable toco objects.  Cannot itself be instantiated.
@@ -366,25 +1138,27 @@ class TocoObject(BaseTocoObject):
     :param kwargs: Keys for an object, and any attributes to attach to that object.
     :rtype: toco object
     '''
-    def __init__(self, _in_db=False, _attempt_load=True, **kwargs):
-        self._needs_reloaded = False
-        self._serialize_as_dict = True
-        self._raise_on_getattr_miss = False
-        self._obj_dict = blob()
-        self._fkey_cache = {}
-        self._obj_loaded = {}
-        self._obj_updates = {}
+    # Internal state lives in slots, so an object's only per-instance dicts are its attribute store and, once used, its
+    # foreign key cache and update record.  Flags that are rarely changed are class-level defaults instead, and only
+    # take up room in the object's __dict__ (which isn't allocated until something is put in it) once they're set.
+    # _attrs is either the blob of attributes, or the raw item it'll be built from (see _from_raw_item).
+    __slots__ = ("_attrs", "_fkeys", "_updates", "_loaded_fields", "_in_db", "__dict__")
+    _needs_reloaded = False
+    _serialize_as_dict = True
+    _raise_on_getattr_miss = False
 
+    def __init__(self, _in_db=False, _attempt_load=True, **kwargs):
+        TocoObject._init_internals(self, blob(), _in_db)
         setattr(self, VERSION_KEY, 0)
-        self._in_db = _in_db
 
         if _attempt_load:
+            from botocore.exceptions import ClientError
             try:
-                description = self.__class__.TABLE().get_item(Key=self._get_key_dict(kwargs))
+                item = self.__class__._get_item(self._get_key_dict(kwargs))
             except ClientError as e:
-                description = {}
-            if description.get('Item'):
-                self._update_attrs(**description['Item'])
+                item = None
+            if item:
+                self._update_attrs(**item)
                 self._clear_update_record()
                 self._in_db = True
                 # Don't treat init-time changes as real changes if they match the DB.
@@ -395,56 +1169,182 @@ class TocoObject(BaseTocoObject):
             object.__setattr__(self, name, value)
         else:
             if isinstance(value, TocoObject):
-                self._obj_dict[name] = value._foreign_key()
+                field = self.__class__._field_codecs().get(name)
+                self._obj_dict[name] = value._foreign_key() if field is None else field.encode(value)
                 self._fkey_cache[name] = value
             else:
                 self._obj_dict[name] = value
-                if name in self._fkey_cache:
-                    del self._fkey_cache[name]
+                fkey_cache = self._fkeys
+                if fkey_cache and name in fkey_cache:
+                    del fkey_cache[name]
             if name != VERSION_KEY:
                 # The version key is special and shouldn't be tracked
                 self._obj_updates[name] = value
 
     def __getattribute__(self, name):
+        # This runs on every attribute access, so it reads the internal slots directly rather than back through itself.
+        get = object.__getattribute__
         if name.startswith("_"):
-            # or name in self.__dict__(name not in self._obj_dict and name not in self.__class__._COMPOUND_ATTRS):
-            if name in object.__getattribute__(self, "__dict__"):
-                return object.__getattribute__(self, "__dict__").get(name)
-            return object.__getattribute__(self, name)
+            return get(self, name)
         else:
-            if self._needs_reloaded:
-                self._reload()
+            if get(self, "_needs_reloaded"):
+                _count_event(self, instrumentation.LAZY_RELOAD)
+                self._reload(use_cache=True)
                 self._needs_reloaded = False
-            if name in self._obj_dict:
-                value = self._obj_dict[name]
+            obj_dict = get(self, "_attrs")
+            if obj_dict.__class__ is dict and isinstance(obj_dict.get(name), (dict, list)):
+                # Containers can be changed in place, so they have to come from the real attribute store.
+                obj_dict = self._obj_dict
+            if name in obj_dict:
+                fkey_cache = get(self, "_fkeys")
+                if fkey_cache and name in fkey_cache:
+                    return fkey_cache[name]
+                value = obj_dict[name]
+                clazz = type(self)
+                codecs = clazz.__dict__.get("_FIELD_CODECS", None)
+                if codecs is None:
+                    codecs = clazz._field_codecs()
+                if codecs and name in codecs:
+                    return self._decode_field(name, codecs[name], value)
                 if is_foreign_key(value):
+                    if value not in CONSTANT_FKEYS:
+                        _count_event(self, "{}:{}".format(instrumentation.LAZY_FKEY_LOAD, name))
                     obj = load_from_fkey(value)
                     self._fkey_cache[name] = obj
                     return obj
                 else:
-                    return load_python_class_if_applicable(self._obj_dict[name])
+                    return load_python_class_if_applicable(value)
             elif name in self.__class__._COMPOUND_ATTRS:
                 return self.__class__._COMPOUND_ATTRS[name]["func"](self)
             else:
                 try:
-                    if name in object.__getattribute__(self, "__dict__"):
-                        return object.__getattribute__(self, "__dict__").get(name)
-                    return object.__getattribute__(self, name)
+                    return get(self, name)
                 except AttributeError as e:
+                    loaded_fields = get(self, "_loaded_fields")
+                    if loaded_fields is not None and name not in loaded_fields:
+                        return self._partial_miss(name)
                     if self._raise_on_getattr_miss:
                         raise e
                     else:
                         return None
 
+    def _decode_field(self, name, field, value):
+        if field.loads_objects and value is not None and value not in CONSTANT_FKEYS:
+            _count_event(self, "{}:{}".format(instrumentation.LAZY_FKEY_LOAD, name))
+        decoded = field.decode(value)
+        # Kept until the attribute is changed, so each value is only decoded once.
+        self._fkey_cache[name] = decoded
+        if isinstance(decoded, (dict, list)):
+            # So that changes made to the decoded container in place are saved.
+            self._obj_dict[name] = decoded
+        return decoded
+
     def __delattr__(self, name):
         if name in self._obj_dict:
             del self._obj_dict[name]
             if name in self._fkey_cache:
                 del self._fkey_cache[name]
             self._obj_updates[name] = None
+        elif self._loaded_fields is not None and not name.startswith("_") and name not in self._loaded_fields:
+            # It may well exist in the DB, so make sure a save removes it.
+            self._obj_updates[name] = None
         else:
             object.__delattr__(self, name)
 
+    def _partial_miss(self, name):
+        if self.__class__._PARTIAL_MISS == "raise":
+            raise AttributeError("{} wasn't loaded; this object was only loaded with the fields {}.".format(name, ", ".join(sorted(self._loaded_fields))))
+        self._fetch_fields([name])
+        return getattr(self, name)
+
+    def _fetch_fields(self, names):
+        '''
+        Fetch attributes that a partial load left out, leaving the ones already loaded (and any unsaved changes) alone.
+        '''
+        names = [name for name in names if name not in self._loaded_fields]
+        if not names:
+            return self
+        item = self.__class__._get_item(self._get_key_dict(), fields=names)
+        item = item if item else {}
+        for name in names:
+            if name in item and name not in self._obj_updates:
+                self._obj_dict[name] = load_constant_fkeys(item[name])
+        self._loaded_fields = self._loaded_fields | frozenset(names)
+        return self
+
+    @classmethod
+    def _from_raw_item(cls, item):
+        '''
+        Build an object that holds item as it is, rather than copying each attribute in through setattr.
+
+        Attributes are decoded (foreign keys, datetimes, constant foreign keys) when they're read, and the object's
+        attribute store is only built from the item once something changes the object or needs all of its attributes.
+        The item must not be modified afterwards.
+        '''
+        if VERSION_KEY not in item:
+            item = dict(item)
+            item[VERSION_KEY] = 0
+        obj = cls.__new__(cls)
+        TocoObject._init_internals(obj, item, True)
+        return obj
+
+    def _init_internals(self, attrs, in_db):
+        # Straight to the slots, skipping __setattr__, as this runs for every object built.
+        init = object.__setattr__
+        init(self, "_attrs", attrs)
+        init(self, "_fkeys", None)
+        init(self, "_updates", None)
+        init(self, "_loaded_fields", None)
+        init(self, "_in_db", in_db)
+
+    @property
+    def _obj_dict(self):
+        '''
+        The blob of the object's attributes, built from the raw item first if the object came from _from_raw_item.
+        '''
+        if not isinstance(self._attrs, blob):
+            self._attrs = blob(load_constant_fkeys(self._attrs))
+        return self._attrs
+
+    @_obj_dict.setter
+    def _obj_dict(self, value):
+        self._attrs = value if isinstance(value, blob) else blob(value)
+
+    @property
+    def _fkey_cache(self):
+        '''
+        Dict of attribute name to the object its foreign key was resolved to, or to the decoded value of a declared field.  Only created once something is put in it.
+        '''
+        if self._fkeys is None:
+            self._fkeys = {}
+        return self._fkeys
+
+    @_fkey_cache.setter
+    def _fkey_cache(self, value):
+        self._fkeys = value
+
+    @property
+    def _obj_updates(self):
+        '''
+        Dict of the attributes changed since the object was loaded or saved (None for removed ones).  Only created once something changes.
+        '''
+        if self._updates is None:
+            self._updates = {}
+        return self._updates
+
+    @_obj_updates.setter
+    def _obj_updates(self, value):
+        self._updates = value
+
+    def _has_updates(self):
+        return bool(self._updates)
+
+    def _item_view(self):
+        '''
+        The object's stored attributes, for reading only.  Unlike _obj_dict, this doesn't build the attribute store of an object from _from_raw_item.
+        '''
+        return self._attrs
+
     def _update_attrs(self, **kwargs):
         kwargs = load_constant_fkeys(kwargs)
         for k in kwargs:
@@ -456,8 +1356,7 @@ class TocoObject(BaseTocoObject):
                 setattr(self, k, kwargs[k])
 
     def _clear_update_record(self):
-        self._obj_loaded = self._obj_dict
-        self._obj_updates = {}
+        self._updates = None
 
     def _get_dict_to_save(self):
         dict_to_save = copy.copy(self._obj_dict)
@@ -484,14 +1383,9 @@ class TocoObject(BaseTocoObject):
         return hash_key, range_key
 
     def _get_key_dict(self, dictionary=None):
-        hash_keyname, range_keyname = self.__class__._HASH_AND_RANGE_KEYS()
-        keys = {}
-        dictionary = dictionary if dictionary else self._obj_dict
-        for k in (hash_keyname, range_keyname):
-            if k and k in dictionary.keys():
-                # I'm explicitly bypassing the getter here in the off chance either hash or range is a foreign key
-                keys[k] = dictionary[k]
-        return keys
+        dictionary = dictionary if dictionary else self._item_view()
+        # I'm explicitly bypassing the getter here in the off chance either hash or range is a foreign key
+        return self.__class__._key_from_dict(dictionary)
 
     def _get_relation_map(self):
         classes = []
@@ -528,19 +1422,55 @@ class TocoObject(BaseTocoObject):
         else:
             return self._foreign_key(), self.__class__.CLASS_NAME()
 
-    def _save(self, force=False, save_if_missing=True, save_if_existing=True, only_if_updated=False):
+    def _save(self, force=False, save_if_missing=True, save_if_existing=True, only_if_updated=False, delta=None):
+        '''
+        Save the object, using VERSION_KEY for optimistic concurrency unless force is set.
+
+        In delta mode (the delta argument, defaulting to the class's _DELTA_SAVES), an object that's already in the DB is saved with an UpdateItem of just the attributes recorded in _obj_updates.
+        New objects, and objects whose key has changed, are always saved with a full put.
+        Note that delta saves can't see in-place changes to mutable attribute values, so reassign those to have them saved.
+        '''
         if not save_if_missing and not save_if_existing:
             raise RuntimeError("At least one of save_if_missing and save_if_existing must be true.")
 
-        if only_if_updated and not self._obj_updates:
+        if only_if_updated and not self._has_updates():
             return self
 
         old_version = getattr(self, VERSION_KEY)
+        create_condition, update_condition, CE = self._save_conditions(force, save_if_missing, save_if_existing)
+        try:
+            setattr(self, VERSION_KEY, old_version+1)
+            if self._saves_as_delta(delta, save_if_existing):
+                from botocore.exceptions import ClientError
+                try:
+                    self._store_delta(update_condition)
+                except ClientError as e:
+                    if not save_if_missing or e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException" or self._loaded_fields is not None:
+                        raise e
+                    # Either the version didn't match or the item has since been deleted; only the latter is allowed to succeed.
+                    self._store(create_condition)
+            elif CE:
+                self._store(CE)
+            else:
+                self._store()
+            self._mark_saved(old_version+1)
+            return self
+        except Exception as e:
+            setattr(self, VERSION_KEY, old_version)
+            # A failed conditional save usually means the cached copy (if any) is out of date.
+            self.__class__._invalidate_cached(self._obj_dict)
+            raise e
+
+    def _save_conditions(self, force, save_if_missing, save_if_existing):
+        '''
+        :rtype: (create condition, update condition, condition for a full put (or None for an unconditional put))
+        '''
+        from boto3.dynamodb.conditions import Attr, Or
         create_condition = Attr(VERSION_KEY).not_exists()
         if force:
             update_condition = Attr(VERSION_KEY).exists()
         else:
-            update_condition = Attr(VERSION_KEY).eq(old_version)
+            update_condition = Attr(VERSION_KEY).eq(getattr(self, VERSION_KEY))
         CE = None
         if force and save_if_missing and save_if_existing:
             pass
@@ -551,18 +1481,87 @@ class TocoObject(BaseTocoObject):
         else:
             # If we're here, we know that create_condition=True
             CE = create_condition
-        try:
-            setattr(self, VERSION_KEY, old_version+1)
-            if CE:
-                self._store(CE)
-            else:
-                self._store()
-            self._clear_update_record()
-            self._in_db = True
-            return self
-        except ClientError as e:
-            setattr(self, VERSION_KEY, old_version)
-            raise e
+        return create_condition, update_condition, CE
+
+    def _saves_as_delta(self, delta, save_if_existing):
+        # A partial object has to be saved as a delta, as a put would drop the attributes that weren't loaded.
+        delta = self.__class__._DELTA_SAVES if delta is None else delta
+        delta = delta or self._loaded_fields is not None
+        key_changed = any(k in (self._updates or ()) for k in self.__class__.KEY_SCHEMA().key_names)
+        return bool(delta and self._in_db and save_if_existing and not key_changed)
+
+    def _mark_saved(self, version):
+        '''
+        Record that the object has been stored with the given version.
+        '''
+        setattr(self, VERSION_KEY, version)
+        self.__class__._invalidate_cached(self._obj_dict, version=version)
+        self._clear_update_record()
+        self._in_db = True
+
+    def _atomic_update(self, update):
+        '''
+        Apply an UpdateExpression directly to the stored item, bypassing optimistic locking (the version isn't checked or bumped), and merge the new values back into this object.
+
+        The item must already exist; otherwise this raises ConditionalCheckFailedException rather than creating a partial item.
+
+        :rtype: dict of the updated attributes' new values
+        '''
+        from boto3.dynamodb.conditions import Attr
+        hash_keyname = self.__class__.KEY_SCHEMA().hash_key
+        response = self.__class__._call_table("update_item", Key=self._get_key_dict(), ConditionExpression=Attr(hash_keyname).exists(), ReturnValues="UPDATED_NEW", **update.params())
+        attributes = response.get("Attributes", {})
+        # The version isn't bumped, so items read before the update have the same version as ones read after it.
+        self.__class__._invalidate_cached(self._obj_dict, version=getattr(self, VERSION_KEY), inclusive=True)
+        for name in update._names.values():
+            if name in attributes:
+                self._obj_dict[name] = attributes[name]
+            elif name in self._obj_dict:
+                # e.g. deleting the last element of a set removes the attribute entirely
+                del self._obj_dict[name]
+            self._fkey_cache.pop(name, None)
+            self._obj_updates.pop(name, None)
+        return attributes
+
+    def increment(self, attrname, amount=1):
+        '''
+        Atomically add amount (which may be negative) to a numeric attribute, treating a missing attribute as 0.
+
+        :rtype: The new value
+        '''
+        update = UpdateExpression()
+        update.add(attrname, ensure_ddbsafe(amount))
+        return self._atomic_update(update).get(attrname)
+
+    def add_to_set(self, attrname, *values):
+        '''
+        Atomically add values to a set attribute, creating it if needed.
+
+        :rtype: The new set
+        '''
+        update = UpdateExpression()
+        update.add(attrname, set(ensure_ddbsafe(list(values))))
+        return self._atomic_update(update).get(attrname)
+
+    def remove_from_set(self, attrname, *values):
+        '''
+        Atomically remove values from a set attribute.
+
+        :rtype: The new set (empty if the attribute no longer exists)
+        '''
+        update = UpdateExpression()
+        update.delete(attrname, set(ensure_ddbsafe(list(values))))
+        return self._atomic_update(update).get(attrname, set())
+
+    def append_to_list(self, attrname, *values):
+        '''
+        Atomically append values to a list attribute, creating it if needed.
+
+        :rtype: The new list
+        '''
+        update = UpdateExpression()
+        update.append(attrname, ensure_ddbsafe(list(values)))
+        return self._atomic_update(update).get(attrname)
 
     def _update(self, force=False):
         return self._save(force=force, save_if_existing=True, save_if_missing=False)
@@ -570,40 +1569,298 @@ class TocoObject(BaseTocoObject):
     def _create(self):
         return self._save(force=force, save_if_existing=False, save_if_missing=True)
 
-    def _store(self, CE=None):
-        dict_to_save = self._get_dict_to_save()
+    def _check_required_attributes(self, dict_to_save):
         required = self._get_required_attributes()
+        if self._loaded_fields is not None:
+            required = [r for r in required if r in self._loaded_fields]
         missing = [r for r in required if not r in dict_to_save or not dict_to_save[r]]
         if missing:
             raise RuntimeError('The following attributes are missing and must be added before saving: '+', '.join(missing))
-        dict_to_save = ensure_ddbsafe(dict_to_save)
+
+    def _item_to_store(self):
+        if self._loaded_fields is not None:
+            raise RuntimeError("A partially loaded object can't be stored as a whole item, as that would drop the attributes that weren't loaded.  Save it normally (which updates just the changed attributes), or _reload() it first.")
+        dict_to_save = self._get_dict_to_save()
+        self._check_required_attributes(dict_to_save)
+        return self.__class__._encode_item(dict_to_save)
+
+    def _delta_update(self):
+        '''
+        The UpdateExpression that brings the stored item in line with this object, based on _obj_updates.
+        '''
+        dict_to_save = self._get_dict_to_save()
+        self._check_required_attributes(dict_to_save)
+        update = UpdateExpression()
+        for name in self._obj_updates:
+            if name in dict_to_save:
+                update.set(name, self.__class__._encode_attr(name, dict_to_save[name]))
+            else:
+                update.remove(name)
+        compattrs = self.__class__._COMPOUND_ATTRS
+        for attrname in compattrs:
+            if compattrs[attrname].get("save", False) and attrname not in self._obj_updates and attrname in dict_to_save:
+                update.set(attrname, self.__class__._encode_attr(attrname, dict_to_save[attrname]))
+        update.set(VERSION_KEY, dict_to_save[VERSION_KEY])
+        return update
+
+    def _store_delta(self, CE=None):
+        params = self._delta_update().params()
         if CE:
-            self.__class__.TABLE().put_item(Item=dict_to_save, ConditionExpression=CE)
-        else:
-            self.__class__.TABLE().put_item(Item=dict_to_save)
+            params["ConditionExpression"] = CE
+        self.__class__._call_table("update_item", Key=self._get_key_dict(), **params)
         return self
 
-    def _delete(self, CE=None):
+    def _store(self, CE=None):
+        dict_to_save = self._item_to_store()
         if CE:
-            return self.__class__.TABLE().delete_item(Key=self._get_key_dict(), ConditionExpression=CE)
+            self.__class__._call_table("put_item", Item=dict_to_save, ConditionExpression=CE)
         else:
-            return self.__class__.TABLE().delete_item(Key=self._get_key_dict())
+            self.__class__._call_table("put_item", Item=dict_to_save)
+        return self
 
-    def _load(self):
+    def _delete(self, CE=None):
+        key = self._get_key_dict()
+        try:
+            if CE:
+                return self.__class__._call_table("delete_item", Key=key, ConditionExpression=CE)
+            else:
+                return self.__class__._call_table("delete_item", Key=key)
+        finally:
+            self.__class__._invalidate_cached(key, version=getattr(self, VERSION_KEY)+1)
+            session = current_session()
+            if session is not None:
+                session.remove(self)
+
+    async def asave(self, **kwargs):
+        '''
+        Async version of _save, taking the same arguments.
+        '''
+        return await aio.run(self.__class__, self._save, **kwargs)
+
+    async def adelete(self, CE=None):
+        '''
+        Async version of _delete.
+        '''
+        return await aio.run(self.__class__, self._delete, CE=CE)
+
+    def _resolve(self, name):
+        '''
+        Read attribute name, loading the object a foreign key refers to now rather than on its first attribute access.
+        '''
+        value = getattr(self, name)
+        if isinstance(value, TocoObject) and value._needs_reloaded:
+            _count_event(value, instrumentation.LAZY_RELOAD)
+            value._reload(use_cache=True)
+            value._needs_reloaded = False
+        return value
+
+    async def aresolve(self, name):
+        '''
+        Async attribute read that may need DynamoDB, i.e. a foreign key dereference.  Values already available are returned without touching the executor.
+
+        :rtype: The attribute's value, with any referenced object fully loaded.
+        '''
+        cached = self._fkeys.get(name) if self._fkeys else None
+        if isinstance(cached, TocoObject) and not cached._needs_reloaded:
+            return cached
+        if self._needs_reloaded or name not in self._item_view():
+            # Reading it may mean reloading this object or fetching a field a partial load left out.
+            return await aio.run(self.__class__, self._resolve, name)
+        value = self._item_view()[name]
+        if not is_foreign_key(value) or value in CONSTANT_FKEYS:
+            return getattr(self, name)
+        clazzname, key, extras = _parse_fkey(value)
+        return await aio.run(get_class(clazzname)._class_for_fkey(**extras), self._resolve, name)
+
+    def _load(self, use_cache=False):
         b = blob()
-        b.update(self.__class__.TABLE().get_item(Key=self._get_key_dict()).get("Item", {}))
-        # return self.__class__.TABLE().get_item(Key=self._get_key_dict()).get("Item", {})
+        item = self.__class__._get_item(self._get_key_dict(), use_cache=use_cache)
+        b.update(item if item else {})
         return b
 
-    def _reload(self):
+    def _reload(self, use_cache=False):
         '''
         Reloads the item's attributes from DynamoDB, replacing whatever's currently in the object.
+
+        :param use_cache: Allow the item to come from the class's cache, if it has one.  Explicit reloads always go to DynamoDB.
         '''
-        self._obj_dict = self._load()
-        self._in_db = True
+        self._obj_dict = self._load(use_cache=use_cache)
+        self._loaded_fields = None
+        self._fkeys = None
+        self._in_db = bool(self._obj_dict)
         self._clear_update_record()
         return self
 
+    @classmethod
+    def batch_writer(cls, flush_amount=BATCH_WRITE_LIMIT):
+        '''
+        Context manager that buffers unconditional saves and deletes and sends them with BatchWriteItem.
+
+        Saves made through the writer behave like _save(force=True): there's no version check, but the version is still bumped.
+
+        :param flush_amount: How many writes to buffer before flushing.  Can't exceed BATCH_WRITE_LIMIT.
+        :rtype: BatchWriter
+        '''
+        return BatchWriter(cls, flush_amount=flush_amount)
+
+    @classmethod
+    def save_many(cls, objs):
+        '''
+        Unconditionally save many objects using BatchWriteItem.
+
+        :param objs: Iterable of toco objects.
+        :rtype: List of the saved objects.
+        '''
+        objs = list(objs)
+        with cls.batch_writer() as writer:
+            for obj in objs:
+                writer.save(obj)
+        return objs
+
+    @classmethod
+    def delete_many(cls, objs):
+        '''
+        Unconditionally delete many objects using BatchWriteItem.
+
+        :param objs: Iterable of toco objects and/or key dicts for this class.
+        '''
+        with cls.batch_writer() as writer:
+            for obj in objs:
+                writer.delete(obj)
+
+class BatchWriter(object):
+    '''
+    Buffers writes of toco objects (possibly of several classes and tables) and flushes them with BatchWriteItem.
+
+    Repeated writes to the same key within a buffer replace each other, as BatchWriteItem rejects duplicate keys.  UnprocessedItems are re-submitted with jittered backoff.
+
+    :param clazz: The class used to interpret key dicts passed to delete.
+    :param flush_amount: How many writes to buffer before flushing.
+    '''
+    def __init__(self, clazz, flush_amount=BATCH_WRITE_LIMIT):
+        if flush_amount < 1 or flush_amount > BATCH_WRITE_LIMIT:
+            raise RuntimeError("flush_amount must be between 1 and {}.".format(BATCH_WRITE_LIMIT))
+        self._clazz = clazz
+        self._flush_amount = flush_amount
+        # (table name, key identity) -> (table name, write request, [(obj, old version or None)])
+        self._buffer = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+    def _add(self, table_name, key, request, bookkeeping):
+        identity = (table_name, _key_identity(key))
+        previous = self._buffer.pop(identity, None)
+        pending = previous[2] if previous else []
+        pending.append(bookkeeping)
+        self._buffer[identity] = (table_name, request, pending)
+        if len(self._buffer) >= self._flush_amount:
+            self.flush()
+
+    def save(self, obj):
+        old_version = getattr(obj, VERSION_KEY)
+        setattr(obj, VERSION_KEY, old_version+1)
+        try:
+            item = obj._item_to_store()
+        except Exception as e:
+            setattr(obj, VERSION_KEY, old_version)
+            raise e
+        clazz = obj.__class__
+        self._add(clazz.TABLE_NAME(), clazz._key_from_dict(item), {"PutRequest":{"Item":item}}, (obj, old_version))
+        return obj
+
+    def delete(self, obj):
+        if isinstance(obj, TocoObject):
+            clazz = obj.__class__
+            key = obj._get_key_dict()
+        else:
+            clazz = self._clazz
+            key = clazz._key_from_dict(obj)
+            obj = None
+        self._add(clazz.TABLE_NAME(), key, {"DeleteRequest":{"Key":key}}, (obj, None))
+
+    def flush(self):
+        while self._buffer:
+            identities = list(self._buffer.keys())[:BATCH_WRITE_LIMIT]
+            request_items = {}
+            for identity in identities:
+                table_name, request, pending = self._buffer[identity]
+                request_items.setdefault(table_name, []).append(request)
+            unprocessed, error = self._send(request_items)
+            failed = self._identities(unprocessed, identities)
+            for identity in identities:
+                if identity not in failed:
+                    self._mark_written(*self._buffer.pop(identity))
+            if error is not None:
+                # What's left either wasn't processed or wasn't sent, so roll back its version bumps.  An object saved
+                # more than once has to end up at the version from before its first save, so they're undone latest first.
+                for identity in list(self._buffer.keys()):
+                    for obj, old_version in reversed(self._buffer.pop(identity)[2]):
+                        if obj is not None and old_version is not None:
+                            setattr(obj, VERSION_KEY, old_version)
+                raise error
+
+    def _mark_written(self, table_name, request, pending):
+        for obj, old_version in pending:
+            clazz = obj.__class__ if obj is not None else self._clazz
+            if "PutRequest" in request:
+                clazz._invalidate_cached(request["PutRequest"]["Item"], version=request["PutRequest"]["Item"][VERSION_KEY])
+            else:
+                clazz._invalidate_cached(request["DeleteRequest"]["Key"])
+            if obj is None:
+                continue
+            if old_version is None:
+                obj._in_db = False
+            else:
+                obj._clear_update_record()
+                obj._in_db = True
+
+    def _identities(self, request_items, identities):
+        '''
+        :rtype: The buffer identities (out of identities) of the requests in request_items.
+        '''
+        if not request_items:
+            return set()
+        # Any class writing to a table can pick the key out of its requests.
+        classes = {}
+        for identity in identities:
+            table_name, request, pending = self._buffer[identity]
+            obj = pending[-1][0]
+            classes.setdefault(table_name, obj.__class__ if obj is not None else self._clazz)
+        found = set()
+        for table_name, requests in request_items.items():
+            for request in requests:
+                item = request["PutRequest"]["Item"] if "PutRequest" in request else request["DeleteRequest"]["Key"]
+                found.add((table_name, _key_identity(classes[table_name]._key_from_dict(item))))
+        return found
+
+    def _send(self, request_items):
+        '''
+        Send request_items, re-submitting UnprocessedItems until they're all done or BATCH_MAX_ATTEMPTS is reached.
+
+        :rtype: (the requests that may not have been processed, or None, and the exception that stopped sending, or None)
+        '''
+        attempt = 0
+        while request_items:
+            try:
+                response = self._clazz._call_resource("batch_write_item", RequestItems=request_items)
+            except Exception as e:
+                return request_items, e
+            request_items = response.get("UnprocessedItems", None)
+            if request_items:
+                if attempt >= BATCH_MAX_ATTEMPTS:
+                    return request_items, RuntimeError("Unable to process all items after {} attempts.".format(attempt+1))
+                _record_retry(self._clazz, "batch_write_item")
+                time.sleep(_backoff_delay(attempt))
+                attempt += 1
+        return None, None
+
+_LAZY_SUBCLASSES = {}
+_CF_CLIENT_LOCK = threading.Lock()
+
 class CFObject(TocoObject):
     '''
     Base class for toco objects that are based on tables created in a CloudFormation stack.
@@ -611,9 +1868,27 @@ class CFObject(TocoObject):
 
     _CF_STACK_NAME = None
     _CF_LOGICAL_NAME = None
-    _CF_CLIENT = boto3.client('cloudformation')
+    # Built on first use (see CF_CLIENT) and shared by every CFObject class, unless a class sets its own.
+    _CF_CLIENT = None
     _CF_TEMPLATE = None
     _CF_RESOURCES = {}
+    # Set _CF_CACHE_FILE to keep templates and resources in a file that outlives the process (see toco.cfcache).
+    _CF_CACHE_FILE = None
+    # If true, cached entries are only used after checking (with DescribeStacks) that the stack hasn't been updated since.
+    _CF_CACHE_VERIFY = False
+    # Stack name to its last update time, as found by _get_stack_updated.
+    _CF_STACK_UPDATED = {}
+
+    @classmethod
+    def CF_CLIENT(cls):
+        '''
+        The CloudFormation client used to look up stacks.  Creating it is slow, so it's only done once a CFObject needs it.
+        '''
+        if cls._CF_CLIENT is None:
+            with _CF_CLIENT_LOCK:
+                if CFObject._CF_CLIENT is None:
+                    CFObject._CF_CLIENT = config.build("client", "cloudformation")
+        return cls._CF_CLIENT
 
     @classmethod
     def _set_cf_info(cls, cf_stack_name=None, cf_logical_name=None):
@@ -645,10 +1920,12 @@ class CFObject(TocoObject):
         stack_name, logical_name = cls._get_stack_and_logical_names(stack_name=stack_name, logical_name=logical_name)
         if logical_name not in cls._CF_RESOURCES:
             logging.warn("Cache miss loading _CF_RESOURCE for class {}".format(cls))
-            response = cls._CF_CLIENT.describe_stack_resource(StackName=stack_name, LogicalResourceId=logical_name)
-            if not response or "StackResourceDetail" not in response:
-                raise RuntimeError("Resource does not exist!")
-            cls._CF_RESOURCES[logical_name] = response["StackResourceDetail"]
+            def fetch():
+                response = cls.CF_CLIENT().describe_stack_resource(StackName=stack_name, LogicalResourceId=logical_name)
+                if not response or "StackResourceDetail" not in response:
+                    raise RuntimeError("Resource does not exist!")
+                return response["StackResourceDetail"]
+            cls._CF_RESOURCES[logical_name] = cls._cf_cached(stack_name, "resource:" + logical_name, fetch)
         else:
             logging.info("Cache hit loading _CF_RESOURCE for class {}".format(cls))
         return cls._CF_RESOURCES[logical_name]
@@ -662,19 +1939,53 @@ class CFObject(TocoObject):
         stack_name = cls._get_stack_name(stack_name=stack_name)
         if not getattr(cls, "_CF_TEMPLATE"):
             logging.warn("Cache miss loading _CF_TEMPLATE for class {}".format(cls))
-            try:
-                template = cls._CF_CLIENT.get_template(StackName=stack_name)["TemplateBody"]
-                setattr(cls, "_CF_TEMPLATE", template)
-            except ValidationError:
-                raise RuntimeError("Unable to retrieve template for stack {}, likely due to it not existing.".format(stack_name))
+            def fetch():
+                from botocore.exceptions import ValidationError
+                try:
+                    return cls.CF_CLIENT().get_template(StackName=stack_name)["TemplateBody"]
+                except ValidationError:
+                    raise RuntimeError("Unable to retrieve template for stack {}, likely due to it not existing.".format(stack_name))
+            setattr(cls, "_CF_TEMPLATE", cls._cf_cached(stack_name, "template", fetch))
         else:
             logging.info("Cache hit loading _CF_TEMPLATE for class {}".format(cls))
         return cls._CF_TEMPLATE
 
     @classmethod
-    def _clear_cf_cache(cls):
+    def _cf_cached(cls, stack_name, name, fetch):
+        '''
+        Look name up in the class's cache file (if it has one), calling fetch and saving the result on a miss.
+        '''
+        if not cls._CF_CACHE_FILE:
+            return fetch()
+        disk = cfcache.cache_file(cls._CF_CACHE_FILE)
+        updated = cls._get_stack_updated(stack_name) if cls._CF_CACHE_VERIFY else None
+        value = disk.get(stack_name, name, updated=updated)
+        if value is None:
+            value = fetch()
+            disk.put(stack_name, updated if updated else cls._get_stack_updated(stack_name), name, value)
+        return value
+
+    @classmethod
+    def _get_stack_updated(cls, stack_name):
+        '''
+        :rtype: When the stack was last updated (or created), as a string.
+        '''
+        if stack_name not in cls._CF_STACK_UPDATED:
+            stack = cls.CF_CLIENT().describe_stacks(StackName=stack_name)["Stacks"][0]
+            cls._CF_STACK_UPDATED[stack_name] = str(stack.get("LastUpdatedTime", stack["CreationTime"]))
+        return cls._CF_STACK_UPDATED[stack_name]
+
+    @classmethod
+    def _clear_cf_cache(cls, persistent=True):
+        '''
+        :param persistent: Also drop the class's stack from its cache file, if it has one.
+        '''
         setattr(cls, "_CF_TEMPLATE", None)
         setattr(cls, "_CF_RESOURCES", {})
+        cls._clear_schema_cache()
+        cls._CF_STACK_UPDATED.pop(cls._CF_STACK_NAME, None)
+        if persistent and cls._CF_CACHE_FILE and cls._CF_STACK_NAME:
+            cfcache.cache_file(cls._CF_CACHE_FILE).invalidate(cls._CF_STACK_NAME)
 
     @classmethod
     def _SCHEMA(cls):
@@ -696,9 +2007,19 @@ class CFObject(TocoObject):
         stack_name, logical_name = obj._get_stack_and_logical_names()
         return {'class':cls.CLASS_NAME(), '_cf_stack_name':stack_name, '_cf_logical_name':logical_name}
 
+    @classmethod
+    def _class_for_fkey(cls, _cf_stack_name, _cf_logical_name, **kwargs):
+        return cls.lazysubclass(stack_name=_cf_stack_name, logical_name=_cf_logical_name)
+
     @classmethod
     def _from_fkey(cls, _cf_stack_name, _cf_logical_name, **kwargs):
-        return cls.lazysubclass(stack_name=_cf_stack_name, logical_name=_cf_logical_name)(**kwargs)
+        clazz = cls._class_for_fkey(_cf_stack_name, _cf_logical_name)
+        existing = clazz._session_get(kwargs)
+        if existing is not None:
+            return existing
+        obj = clazz(**kwargs)
+        session = current_session()
+        return session.add(obj) if session is not None else obj
 
     @classmethod
     def lazysubclass(cls, stack_name=None, logical_name=None):
@@ -706,10 +2027,17 @@ class CFObject(TocoObject):
         Returns a class that inherits from this one, with the given default stack and logical names.
         If you just want to have a new object type with no fancy features added, this makes it a one-liner.
 
+        The same class is returned for repeated calls with the same arguments, so foreign key dereferences don't build (and re-cache schemas for) a new class every time.
+
         :rtype: Class that inherits from cls
         '''
-        class LazyObject(cls):
-            _CF_STACK_NAME = stack_name if stack_name else cls._CF_STACK_NAME
-            _CF_LOGICAL_NAME = logical_name if logical_name else cls._CF_LOGICAL_NAME
-            _CLASSNAME = cls.CLASS_NAME()
-        return LazyObject
+        stack_name = stack_name if stack_name else cls._CF_STACK_NAME
+        logical_name = logical_name if logical_name else cls._CF_LOGICAL_NAME
+        cache_key = (cls, stack_name, logical_name)
+        if cache_key not in _LAZY_SUBCLASSES:
+            class LazyObject(cls):
+                _CF_STACK_NAME = stack_name
+                _CF_LOGICAL_NAME = logical_name
+                _CLASSNAME = cls.CLASS_NAME()
+            _LAZY_SUBCLASSES[cache_key] = LazyObject
+        return _LAZY_SUBCLASSES[cache_key]
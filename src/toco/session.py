@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+'''
+Sessions give a unit of work (e.g. one web request) an identity map, so each item is materialized at most once.
+
+Usage::
+
+    with toco.session() as s:
+        user = User.load(id="u1")
+        token.user is user            # foreign keys resolve to the same instance
+        Post.query(...)                # items already in the session come back as the existing instances
+        user.name = "new name"
+        s.flush()                      # writes every object with unsaved changes
+
+Within a session, load(), load_many(), query/scan results and foreign key dereferences all consult the identity map
+before constructing a new object.  Sessions are tracked per thread and per asyncio task.
+'''
+
+import contextvars
+
+_CURRENT_SESSION = contextvars.ContextVar("toco_session", default=None)
+
+class Session(object):
+    '''
+    An identity map of toco objects keyed by (table name, key).
+
+    :param autoflush: Flush when the session's with block exits without an exception.
+    '''
+    def __init__(self, autoflush=False):
+        self.autoflush = autoflush
+        self._identity_map = {}
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_CURRENT_SESSION.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if self.autoflush and exc_type is None:
+                self.flush()
+        finally:
+            _CURRENT_SESSION.reset(self._tokens.pop())
+
+    def __len__(self):
+        return len(self._identity_map)
+
+    def __contains__(self, obj):
+        return self._identity_map.get(obj.__class__._identity(obj._get_key_dict())) is obj
+
+    def get(self, clazz, key):
+        '''
+        :param clazz: The toco class (used to find the table and key schema).
+        :param key: A dict containing at least the object's key attributes.
+        :rtype: The instance already in the session, or None.
+        '''
+        return self._identity_map.get(clazz._identity(key))
+
+    def add(self, obj):
+        '''
+        Add obj to the session, unless an instance for the same item is already there.
+
+        :rtype: Whichever instance is now in the session for that item.
+        '''
+        return self._identity_map.setdefault(obj.__class__._identity(obj._get_key_dict()), obj)
+
+    def remove(self, obj):
+        identity = obj.__class__._identity(obj._get_key_dict())
+        if self._identity_map.get(identity) is obj:
+            del self._identity_map[identity]
+
+    def clear(self):
+        self._identity_map = {}
+
+    def dirty(self):
+        '''
+        :rtype: List of the objects in the session with unsaved changes.
+        '''
+        return [obj for obj in self._identity_map.values() if obj._has_updates()]
+
+    def flush(self, force=False):
+        '''
+        Save every dirty object in the session.
+
+        Saves have the same version checks as _save(), and are sent with TransactWriteItems, so each chunk of up to
+        TRANSACT_WRITE_LIMIT objects is saved all or nothing: if any object in it was changed elsewhere since it was
+        read, a ClientError (TransactionCanceledException) is raised and none of that chunk is saved.
+
+        :param force: Skip the version checks and send unconditional puts with BatchWriteItem (like _save(force=True)), overwriting any changes made elsewhere.  Partially loaded objects are still saved individually, as deltas.
+        :rtype: List of the objects that were saved.
+        '''
+        dirty = self.dirty()
+        if not dirty:
+            return dirty
+        if not force:
+            from .transaction import Transaction
+            with Transaction() as tx:
+                for obj in dirty:
+                    tx.save(obj)
+            return dirty
+        # Partially loaded objects can only be saved as deltas, which BatchWriteItem can't do.
+        batch = [obj for obj in dirty if obj._loaded_fields is None]
+        if batch:
+            with batch[0].__class__.batch_writer() as writer:
+                for obj in batch:
+                    writer.save(obj)
+        for obj in dirty:
+            if obj._loaded_fields is not None:
+                obj._save(force=True)
+        return dirty
+
+def session(autoflush=False):
+    '''
+    Start a new session; use it as a context manager.
+
+    :rtype: Session
+    '''
+    return Session(autoflush=autoflush)
+
+def current_session():
+    '''
+    :rtype: The innermost active Session, or None.
+    '''
+    return _CURRENT_SESSION.get()
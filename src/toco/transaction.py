@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+'''
+All-or-nothing writes and consistent multi-object reads, using TransactWriteItems and TransactGetItems.
+
+Usage::
+
+    with toco.transaction() as tx:
+        tx.save(order)                   # versioned put, just like order._save()
+        tx.save(customer, delta=True)    # versioned UpdateItem of the changed attributes
+        tx.delete(cart)
+        tx.check(inventory)              # fails the transaction if inventory has changed since it was read
+
+    order, customer = toco.transact_get([order, (Customer, {"id":"c1"})])
+
+The transaction is committed when the with block exits without an exception, and discarded otherwise.  Objects (and
+their versions) are only updated once the write they belong to has succeeded.
+'''
+
+import functools
+
+from .object import VERSION_KEY
+from .session import current_session
+
+# The most items DynamoDB accepts in a single TransactWriteItems or TransactGetItems call.
+TRANSACT_WRITE_LIMIT = 100
+TRANSACT_GET_LIMIT = 100
+
+class Transaction(object):
+    '''
+    Collects writes to any number of toco objects (across tables and classes) and commits them together.
+
+    A request is built from the object's state at the time it's added, so changes made afterwards aren't included.
+    Up to TRANSACT_WRITE_LIMIT writes are committed atomically; larger transactions are split into several
+    TransactWriteItems calls, each of which is atomic on its own.
+    '''
+    def __init__(self):
+        self._requests = []
+        self._identities = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+
+    def __len__(self):
+        return len(self._requests)
+
+    def _add(self, obj, action, request, on_success):
+        clazz = obj.__class__
+        identity = clazz._identity(obj._get_key_dict())
+        if identity in self._identities:
+            raise RuntimeError("A transaction can only include one operation per item, and already has one for {} in {}.".format(dict(identity[1]), identity[0]))
+        self._identities.add(identity)
+        request["TableName"] = clazz.TABLE_NAME()
+        self._requests.append((clazz, {action:request}, on_success))
+        return obj
+
+    def save(self, obj, force=False, save_if_missing=True, save_if_existing=True, only_if_updated=False, delta=None):
+        '''
+        Add a save of obj, with the same arguments and version checks as obj._save().
+
+        A delta save of an object that's since been deleted fails the transaction, rather than falling back to a put.
+        '''
+        if not save_if_missing and not save_if_existing:
+            raise RuntimeError("At least one of save_if_missing and save_if_existing must be true.")
+        if only_if_updated and not obj._has_updates():
+            return obj
+        old_version = getattr(obj, VERSION_KEY)
+        create_condition, update_condition, CE = obj._save_conditions(force, save_if_missing, save_if_existing)
+        try:
+            # The stored item carries the new version, but obj doesn't until the transaction succeeds.
+            setattr(obj, VERSION_KEY, old_version+1)
+            if obj._saves_as_delta(delta, save_if_existing):
+                action = "Update"
+                request = dict(obj._delta_update().params(), Key=obj._get_key_dict(), ConditionExpression=update_condition)
+            else:
+                action = "Put"
+                request = {"Item":obj._item_to_store()}
+                if CE:
+                    request["ConditionExpression"] = CE
+        finally:
+            setattr(obj, VERSION_KEY, old_version)
+        return self._add(obj, action, request, functools.partial(obj._mark_saved, old_version+1))
+
+    def delete(self, obj, CE=None):
+        '''
+        Add a delete of obj, optionally conditional on CE.
+        '''
+        request = {"Key":obj._get_key_dict()}
+        if CE:
+            request["ConditionExpression"] = CE
+        return self._add(obj, "Delete", request, functools.partial(_mark_deleted, obj))
+
+    def check(self, obj, condition=None):
+        '''
+        Add a condition check on obj's item, which isn't written.
+
+        :param condition: The condition the stored item must meet.  Defaults to it still having obj's version, i.e. not having been changed since obj was read.
+        '''
+        if condition is None:
+            from boto3.dynamodb.conditions import Attr
+            condition = Attr(VERSION_KEY).eq(getattr(obj, VERSION_KEY))
+        return self._add(obj, "ConditionCheck", {"Key":obj._get_key_dict(), "ConditionExpression":condition}, None)
+
+    def commit(self):
+        '''
+        Send the collected writes.  A failed condition raises a ClientError with code TransactionCanceledException.
+        '''
+        requests, self._requests, self._identities = self._requests, [], set()
+        for start in range(0, len(requests), TRANSACT_WRITE_LIMIT):
+            chunk = requests[start:start+TRANSACT_WRITE_LIMIT]
+            chunk[0][0]._call_resource("transact_write_items", TransactItems=[request for clazz, request, on_success in chunk])
+            for clazz, request, on_success in chunk:
+                if on_success:
+                    on_success()
+
+def _mark_deleted(obj):
+    obj.__class__._invalidate_cached(obj._get_key_dict(), version=getattr(obj, VERSION_KEY)+1)
+    obj._in_db = False
+    session = current_session()
+    if session is not None:
+        session.remove(obj)
+
+def transaction():
+    '''
+    Start a new transaction; use it as a context manager.
+
+    :rtype: Transaction
+    '''
+    return Transaction()
+
+def transact_get(requests):
+    '''
+    Read several items (across tables and classes) as one consistent snapshot, using TransactGetItems.
+
+    More than TRANSACT_GET_LIMIT items are read in several calls, each of which is consistent on its own.
+
+    :param requests: Iterable of toco objects (whose keys are read) and/or (class, key dict) pairs.
+    :rtype: List of toco objects in the same order as requests, with None in place of any that weren't found.
+    '''
+    keyed = []
+    for request in requests:
+        if isinstance(request, tuple):
+            clazz, key = request
+        else:
+            clazz, key = request.__class__, request._get_key_dict()
+        keyed.append((clazz, clazz._key_from_dict(key)))
+    objs = []
+    for start in range(0, len(keyed), TRANSACT_GET_LIMIT):
+        chunk = keyed[start:start+TRANSACT_GET_LIMIT]
+        response = chunk[0][0]._call_resource("transact_get_items", TransactItems=[{"Get":{"TableName":clazz.TABLE_NAME(), "Key":key}} for clazz, key in chunk])
+        for (clazz, key), entry in zip(chunk, response.get("Responses", [])):
+            objs.append(clazz._from_item(entry["Item"]) if "Item" in entry else None)
+    return objs
@@ -0,0 +1,97 @@
+import unittest
+
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from decimal import Decimal
+
+from toco.memory import MemoryBackend, PAGE_SIZE
+
+SCHEMA = {
+    "TableName":"things",
+    "KeySchema":[{"AttributeName":"id","KeyType":"HASH"},{"AttributeName":"n","KeyType":"RANGE"}],
+    "AttributeDefinitions":[{"AttributeName":"id","AttributeType":"S"},{"AttributeName":"n","AttributeType":"N"}],
+    "GlobalSecondaryIndexes":[{"IndexName":"by_tag","KeySchema":[{"AttributeName":"tag","KeyType":"HASH"}]}],
+}
+
+class TestMemoryBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend(page_size=1000)
+        self.backend.create_table(**SCHEMA)
+        self.table = self.backend.Table("things")
+        for i in range(50):
+            self.table.put_item(Item={"id":"a" if i < 25 else "b", "n":i, "tag":"even" if i % 2 == 0 else "odd", "body":"x" * 100})
+
+    def test_get_item_normalizes_values(self):
+        item = self.table.get_item(Key={"id":"a", "n":3})["Item"]
+        self.assertEqual(Decimal(3), item["n"])
+        self.assertIsInstance(item["n"], Decimal)
+        self.assertNotIn("Item", self.table.get_item(Key={"id":"a", "n":99}))
+
+    def test_floats_are_rejected(self):
+        with self.assertRaises(TypeError):
+            self.table.put_item(Item={"id":"c", "n":1, "f":1.5})
+
+    def test_conditional_put(self):
+        with self.assertRaises(ClientError) as cm:
+            self.table.put_item(Item={"id":"a", "n":1}, ConditionExpression=Attr("id").not_exists())
+        self.assertEqual("ConditionalCheckFailedException", cm.exception.response["Error"]["Code"])
+        self.table.put_item(Item={"id":"a", "n":1, "v":2}, ConditionExpression=Attr("tag").eq("odd") & Attr("n").between(0, 5))
+        self.assertEqual(2, self.table.get_item(Key={"id":"a", "n":1})["Item"]["v"])
+
+    def test_update_expression(self):
+        response = self.table.update_item(
+            Key={"id":"a", "n":1},
+            UpdateExpression="SET #c = if_not_exists(#c, :zero) + :one, #l = list_append(if_not_exists(#l, :empty), :l) REMOVE body ADD #s :s",
+            ExpressionAttributeNames={"#c":"count", "#l":"list", "#s":"set"},
+            ExpressionAttributeValues={":zero":0, ":one":1, ":empty":[], ":l":["x"], ":s":{"y"}},
+            ReturnValues="ALL_NEW",
+        )
+        item = response["Attributes"]
+        self.assertEqual(1, item["count"])
+        self.assertEqual(["x"], item["list"])
+        self.assertEqual({"y"}, item["set"])
+        self.assertNotIn("body", item)
+
+    def test_query_paginates_at_page_size(self):
+        response = self.table.query(KeyConditionExpression=Key("id").eq("a"))
+        self.assertIn("LastEvaluatedKey", response)
+        items = list(response["Items"])
+        while "LastEvaluatedKey" in response:
+            response = self.table.query(KeyConditionExpression=Key("id").eq("a"), ExclusiveStartKey=response["LastEvaluatedKey"])
+            items.extend(response["Items"])
+        self.assertEqual(list(range(25)), [int(item["n"]) for item in items])
+
+    def test_query_index_and_filter(self):
+        self.backend.page_size = PAGE_SIZE
+        response = self.table.query(IndexName="by_tag", KeyConditionExpression=Key("tag").eq("odd"), FilterExpression=Attr("n").gt(40))
+        self.assertEqual([41, 43, 45, 47, 49], sorted(int(item["n"]) for item in response["Items"]))
+
+    def test_scan_segments_cover_table(self):
+        seen = []
+        for segment in range(3):
+            response = {}
+            while True:
+                params = {"Segment":segment, "TotalSegments":3}
+                if response.get("LastEvaluatedKey"):
+                    params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+                response = self.table.scan(**params)
+                seen.extend((item["id"], int(item["n"])) for item in response["Items"])
+                if "LastEvaluatedKey" not in response:
+                    break
+        self.assertEqual(50, len(set(seen)))
+        self.assertEqual(50, len(seen))
+
+    def test_batch_throttling_returns_unprocessed(self):
+        backend = MemoryBackend(throttle_rate=0.5, seed=1)
+        backend.create_table(**SCHEMA)
+        response = backend.batch_write_item(RequestItems={"things":[{"PutRequest":{"Item":{"id":"a", "n":i}}} for i in range(20)]})
+        self.assertTrue(response["UnprocessedItems"]["things"])
+        self.assertLess(len(backend.Table("things").items), 20)
+
+    def test_consumed_capacity(self):
+        response = self.table.get_item(Key={"id":"a", "n":1}, ReturnConsumedCapacity="TOTAL", ConsistentRead=True)
+        self.assertEqual(1.0, response["ConsumedCapacity"]["CapacityUnits"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,645 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+import copy
+import json
+from datetime import datetime
+from decimal import Decimal
+import os
+import random
+import tempfile
 import unittest
+from unittest import mock
 
-class TestObjectMethods(unittest.TestCase):
+import toco
+import toco.backend
+from toco import aio, fields, instrumentation
+from toco.memory import MemoryBackend
+from toco.object import CFObject, TocoObject, VERSION_KEY, blob
+
+class Model(TocoObject):
+    pass
+
+class User(Model):
+    @classmethod
+    def _SCHEMA(cls):
+        return {
+            "TableName":"users",
+            "KeySchema":[{"AttributeName":"id","KeyType":"HASH"}],
+            "AttributeDefinitions":[{"AttributeName":"id","AttributeType":"S"}],
+        }
+
+class Post(Model):
+    @classmethod
+    def _SCHEMA(cls):
+        return {
+            "TableName":"posts",
+            "KeySchema":[{"AttributeName":"user_id","KeyType":"HASH"},{"AttributeName":"n","KeyType":"RANGE"}],
+            "AttributeDefinitions":[{"AttributeName":"user_id","AttributeType":"S"},{"AttributeName":"n","AttributeType":"N"}],
+        }
+
+class StrictPost(Post):
+    _PARTIAL_MISS = "raise"
+
+class RemoteUser(User):
+    # Given its own backend by the tests that use it.
+    pass
+
+class TypedPost(Post):
+    _FIELDS = {
+        "n":fields.Int(),
+        "score":fields.Float(),
+        "price":fields.Decimal(),
+        "published":fields.DateTime(),
+        "draft":fields.Bool(),
+        "body":fields.Bytes(),
+        "tags":fields.List(fields.String()),
+        "counts":fields.Map(fields.Int()),
+        "user":fields.ForeignKey(User),
+    }
+
+class TocoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryBackend(page_size=1000)
+        Model._BACKEND = self.backend
+        User.create_table()
+        Post.create_table()
+        self.users = User.save_many([User(id="u{}".format(i), name="user {}".format(i), _attempt_load=False) for i in range(5)])
+        self.posts = Post.save_many([Post(user_id="u{}".format(i % 5), n=i, user=self.users[i % 5], _attempt_load=False) for i in range(1, 101)])
+
+    def tearDown(self):
+        Model._BACKEND = None
+
+class TestObjectMethods(TocoTestCase):
 
     def test_noop(self):
         self.assertEqual(True, True)
 
+    def test_save_and_load(self):
+        post = Post.load(user_id="u1", n=6)
+        self.assertEqual(1, getattr(post, VERSION_KEY))
+        post.title = "hello"
+        post._save()
+        self.assertEqual("hello", Post.load(user_id="u1", n=6).title)
+        self.assertIsNone(Post.load(user_id="u1", n=7))
+
+    def test_load_many_preserves_order(self):
+        keys = [{"id":"u3"}, {"id":"missing"}, {"id":"u1"}, {"id":"u3"}]
+        users = User.load_many(keys)
+        self.assertEqual(["u3", None, "u1", "u3"], [u.id if u else None for u in users])
+
+    def test_batch_writer_deletes(self):
+        Post.delete_many([{"user_id":"u1", "n":1}, self.posts[1]])
+        self.assertIsNone(Post.load(user_id="u1", n=1))
+        self.assertIsNone(Post.load(user_id="u2", n=2))
+        self.assertFalse(self.posts[1]._in_db)
+
+    def test_prefetch_populates_fkey_cache(self):
+        posts = Post.query(user_id="u2", prefetch=["user"])["Items"]
+        self.assertTrue(all("user" in post._fkey_cache for post in posts))
+        self.assertEqual("user 2", posts[0].user.name)
+        self.assertIs(posts[0].user, posts[1].user)
+
+    def test_prefetch_asks_each_class_its_own_backend(self):
+        RemoteUser._BACKEND = MemoryBackend()
+        self.addCleanup(setattr, RemoteUser, "_BACKEND", None)
+        RemoteUser.create_table()
+        RemoteUser(id="r1", name="remote", _attempt_load=False)._save()
+        post = Post.load(user_id="u1", n=6)
+        post.user = RemoteUser.load(id="r1")
+        post.other = User.load(id="u2")
+        post._save()
+        post = Post.load_many([{"user_id":"u1", "n":6}], prefetch=["user", "other"])[0]
+        self.assertEqual(("remote", "user 2"), (post._fkey_cache["user"].name, post._fkey_cache["other"].name))
+
+    def test_iter_query_follows_pages(self):
+        self.assertIsNotNone(Post.query(user_id="u0")["NextToken"])
+        self.assertEqual(20, len(list(Post.iter_query(user_id="u0", read_ahead=True))))
+        self.assertEqual(7, len(list(Post.iter_scan(max_items=7))))
+
+    def test_parallel_scan(self):
+        progress = {}
+        ns = [post.n for post in Post.parallel_scan(4, on_progress=lambda segment, token, count: progress.__setitem__(segment, token))]
+        self.assertEqual(list(range(1, 101)), sorted(ns))
+        self.assertEqual({0:None, 1:None, 2:None, 3:None}, progress)
+
+    @mock.patch("toco.object.SCAN_POLL_INTERVAL", 0.05)
+    def test_parallel_scan_raises_worker_failures(self):
+        with self.assertRaises(ValueError):
+            list(Post.parallel_scan(2, segment_tokens={0:"not-a-token"}))
+        # The callback can't be pickled, so the segments never start.
+        with self.assertRaises(Exception):
+            list(Post.parallel_scan(2, use_processes=True, callback=lambda post: post.n))
+
+    def test_delta_save(self):
+        post = Post.load(user_id="u1", n=6)
+        stale = Post.load(user_id="u1", n=6)
+        post.title = "delta"
+        del post.user
+        post._save(delta=True)
+        stored = Post.load(user_id="u1", n=6)
+        self.assertEqual("delta", stored.title)
+        self.assertNotIn("user", stored._obj_dict)
+        self.assertEqual(2, getattr(stored, VERSION_KEY))
+        stale.title = "stale"
+        with self.assertRaises(Exception):
+            stale._save(delta=True)
+
+    def test_atomic_operations(self):
+        post = Post.load(user_id="u1", n=6)
+        self.assertEqual(2, post.increment("views", 2))
+        self.assertEqual(5, post.increment("views", 3))
+        self.assertEqual({"a", "b"}, post.add_to_set("tags", "a", "b"))
+        self.assertEqual({"b"}, post.remove_from_set("tags", "a"))
+        self.assertEqual(["x", "y"], post.append_to_list("history", "x", "y"))
+        stored = Post.load(user_id="u1", n=6)
+        self.assertEqual(5, stored.views)
+        self.assertEqual(1, getattr(stored, VERSION_KEY))
+
+    def test_lazy_items_decode_on_access(self):
+        post = Post.load(user_id="u1", n=6)
+        post.empty = ""
+        post.tags = ["a", ""]
+        post._save()
+        item = Post.TABLE().get_item(Key={"user_id":"u1", "n":6})["Item"]
+        lazy = Post._from_item(item, lazy=True)
+        self.assertEqual(("", "user 1", 2), (lazy.empty, lazy.user.name, getattr(lazy, VERSION_KEY)))
+        self.assertNotIsInstance(lazy._attrs, blob)
+        lazy.tags.append("b")
+        lazy.title = "lazy"
+        self.assertEqual({"title":"lazy"}, lazy._obj_updates)
+        lazy._save()
+        stored = Post.load(user_id="u1", n=6)
+        self.assertEqual(("lazy", ["a", "", "b"], 3), (stored.title, stored.tags, getattr(stored, VERSION_KEY)))
+
+    def test_tracking_dicts_are_created_lazily(self):
+        post = Post.query(user_id="u1")["Items"][0]
+        self.assertEqual((None, None, {}), (post._updates, post._fkeys, vars(post)))
+        post.title = "changed"
+        post.user
+        self.assertEqual(({"title":"changed"}, ["user"]), (post._obj_updates, list(post._fkey_cache)))
+
+    def test_partial_loads(self):
+        post = Post.load(user_id="u1", n=6)
+        post.title, post.body = "title", "body"
+        post._save()
+        partial = Post.load(user_id="u1", n=6, fields=["title"])
+        self.assertNotIn("body", partial._obj_dict)
+        self.assertEqual("body", partial.body)
+        partial = Post.query(user_id="u1", fields=["title"])["Items"][1]
+        partial.title = "changed"
+        partial._save()
+        stored = Post.load(user_id="u1", n=6)
+        self.assertEqual(("changed", "body", 3), (stored.title, stored.body, getattr(stored, VERSION_KEY)))
+        self.assertEqual("u1", stored.user.id)
+        with self.assertRaises(RuntimeError):
+            Post.save_many(Post.load_many([{"user_id":"u1", "n":6}], fields=["title"]))
+
+    def test_partial_miss_can_raise(self):
+        strict = StrictPost.load(user_id="u1", n=6, fields=["title"])
+        with self.assertRaises(AttributeError):
+            strict.user
+
+class TestBlob(unittest.TestCase):
+
+    def test_attributes_are_items(self):
+        b = blob({"a":1, "keys":2})
+        b.c = 3
+        del b.a
+        self.assertEqual({"keys":2, "c":3}, b)
+        self.assertEqual((3, None, 2), (b.c, b.a, b["keys"]))
+        self.assertTrue(callable(b.keys))
+        self.assertFalse(hasattr(b, "__dict__"))
+
+    def test_raise_on_miss(self):
+        b = copy.deepcopy(blob({"a":1}, raise_on_miss=True))
+        self.assertEqual(1, b.a)
+        with self.assertRaises(AttributeError):
+            b.missing
+
+class CachedUser(User):
+    _CACHE_SIZE = 2
+
+class TestObjectCache(TocoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # The users saved by TocoTestCase.setUp leave tombstones in the shared users cache.
+        CachedUser.OBJECT_CACHE().clear()
+
+    def tearDown(self):
+        CachedUser.OBJECT_CACHE().clear()
+        super().tearDown()
+
+    def test_partly_failed_batch_only_rolls_back_unwritten_items(self):
+        for i in range(2):
+            CachedUser.load(id="u{}".format(i))
+        users = [CachedUser(id="u{}".format(i), name="new {}".format(i), _attempt_load=False) for i in range(10)]
+        self.backend.throttle_rate = 0.5
+        self.backend._random = random.Random(1)
+        with mock.patch("toco.object.BATCH_MAX_ATTEMPTS", 0):
+            self.assertRaises(RuntimeError, CachedUser.save_many, users)
+        self.backend.throttle_rate = 0
+        written = [user for user in users if user._in_db]
+        self.assertTrue(0 < len(written) < len(users))
+        for user in users:
+            stored = self.backend.Table("users").get_item(Key={"id":user.id}).get("Item", {})
+            if user._in_db:
+                self.assertEqual((1, user.name), (getattr(user, VERSION_KEY), stored["name"]))
+                # Including the ones whose old versions were cached.
+                self.assertEqual(user.name, CachedUser.load(id=user.id).name)
+            else:
+                self.assertEqual(0, getattr(user, VERSION_KEY))
+                self.assertNotEqual(user.name, stored.get("name"))
+        for user in written:
+            user.name = "again"
+            user._save()
+
+    def test_failed_batch_rolls_back_repeated_saves_to_the_first_version(self):
+        user = User.load(id="u1")
+        self.backend.throttle_rate = 1
+        with mock.patch("toco.object.BATCH_MAX_ATTEMPTS", 0):
+            with self.assertRaises(RuntimeError):
+                with User.batch_writer() as writer:
+                    writer.save(user)
+                    user.name = "twice"
+                    writer.save(user)
+        self.backend.throttle_rate = 0
+        self.assertEqual(1, getattr(user, VERSION_KEY))
+        user._save()
+        self.assertEqual("twice", User.load(id="u1").name)
+
+    def test_writes_through_other_classes_on_the_table_invalidate(self):
+        self.assertEqual("user 1", CachedUser.load(id="u1").name)
+        user = User.load(id="u1")
+        user.name = "renamed"
+        user._save()
+        self.assertEqual("renamed", CachedUser.load(id="u1").name)
+
+    def test_load_is_read_through(self):
+        CachedUser.load(id="u1")
+        self.backend.Table("users").put_item(Item={"id":"u1", "name":"changed behind toco's back", VERSION_KEY:1})
+        self.assertEqual("user 1", CachedUser.load(id="u1").name)
+        self.assertEqual(1, CachedUser.cache_stats()["hits"])
+        self.assertEqual("changed behind toco's back", CachedUser.load(id="u1")._reload().name)
+
+    def test_save_invalidates_and_blocks_stale_puts(self):
+        user = CachedUser.load(id="u1")
+        stale_item = dict(user._obj_dict)
+        user.name = "renamed"
+        user._save()
+        cache = CachedUser.OBJECT_CACHE()
+        cache.put((("id", "u1"),), stale_item)
+        self.assertEqual(1, CachedUser.cache_stats()["stale_puts"])
+        self.assertEqual("renamed", CachedUser.load(id="u1").name)
+        # Atomic updates don't bump the version, so an item read before one has the same version as the stored one.
+        stale_item = dict(CachedUser.load(id="u1")._obj_dict)
+        user.increment("views", 5)
+        cache.put((("id", "u1"),), stale_item)
+        self.assertEqual(2, CachedUser.cache_stats()["stale_puts"])
+        self.assertEqual(5, CachedUser.load(id="u1").views)
+
+    def test_lru_eviction(self):
+        evictions = CachedUser.cache_stats()["evictions"]
+        CachedUser.load_many([{"id":"u1"}, {"id":"u2"}, {"id":"u3"}])
+        self.assertEqual(evictions + 1, CachedUser.cache_stats()["evictions"])
+        self.assertEqual(["u1", "u2", "u3"], [u.id for u in CachedUser.load_many([{"id":"u1"}, {"id":"u2"}, {"id":"u3"}])])
+
+class TestSession(TocoTestCase):
+
+    def test_identity_map(self):
+        with toco.session() as session:
+            user = User.load(id="u1")
+            self.assertIs(user, User.load(id="u1"))
+            self.assertIs(user, User.load_many([{"id":"u1"}])[0])
+            posts = Post.query(user_id="u1")["Items"]
+            self.assertTrue(all(post.user is user for post in posts))
+            self.assertIs(posts[0], Post.load(user_id="u1", n=posts[0].n))
+        self.assertIsNone(toco.current_session())
+        self.assertIsNot(user, User.load(id="u1"))
+
+    def test_flush_writes_dirty_objects(self):
+        with toco.session() as session:
+            posts = Post.query(user_id="u2", prefetch=["user"])["Items"]
+            posts[0].user.name = "renamed"
+            posts[1].title = "titled"
+            self.assertEqual(2, len(session.dirty()))
+            session.flush()
+            self.assertEqual([], session.dirty())
+        self.assertEqual("renamed", User.load(id="u2").name)
+        self.assertEqual("titled", Post.load(user_id="u2", n=posts[1].n).title)
+
+    def test_flush_checks_versions(self):
+        with toco.session() as session:
+            user = User.load(id="u1")
+            user.name = "session"
+        elsewhere = User.load(id="u1")
+        elsewhere.name = "elsewhere"
+        elsewhere.email = "u1@example.com"
+        elsewhere._save()
+        with self.assertRaises(ClientError) as raised:
+            session.flush()
+        self.assertEqual("TransactionCanceledException", raised.exception.response["Error"]["Code"])
+        self.assertEqual([user], session.dirty())
+        stored = User.load(id="u1")
+        self.assertEqual(("elsewhere", "u1@example.com", 2), (stored.name, stored.email, getattr(stored, VERSION_KEY)))
+        session.flush(force=True)
+        self.assertEqual("session", User.load(id="u1").name)
+
+class TestTransaction(TocoTestCase):
+
+    def test_commits_everything_or_nothing(self):
+        user, post, other = User.load(id="u1"), Post.load(user_id="u1", n=6), Post.load(user_id="u2", n=7)
+        stale = Post.load(user_id="u2", n=7)
+        stale.title = "changed first"
+        stale._save()
+        user.name = "renamed"
+        post.title = "titled"
+        with self.assertRaises(ClientError) as raised:
+            with toco.transaction() as tx:
+                tx.save(user)
+                tx.save(post, delta=True)
+                tx.check(other)
+        self.assertEqual("TransactionCanceledException", raised.exception.response["Error"]["Code"])
+        self.assertEqual(1, getattr(user, VERSION_KEY))
+        self.assertEqual("user 1", User.load(id="u1").name)
+        with toco.transaction() as tx:
+            tx.save(user)
+            tx.save(post, delta=True)
+            tx.delete(stale)
+        self.assertEqual(2, getattr(user, VERSION_KEY))
+        self.assertEqual({}, post._obj_updates)
+        self.assertFalse(stale._in_db)
+        loaded_user, loaded_post, deleted = toco.transact_get([user, (Post, {"user_id":"u1", "n":6}), stale])
+        self.assertEqual("renamed", loaded_user.name)
+        self.assertEqual(("titled", 2), (loaded_post.title, getattr(loaded_post, VERSION_KEY)))
+        self.assertIsNone(deleted)
+
+    def test_rejects_two_operations_on_one_item(self):
+        tx = toco.transaction()
+        tx.save(User.load(id="u1"))
+        with self.assertRaises(RuntimeError):
+            tx.delete(User.load(id="u1"))
+
+class TestFields(TocoTestCase):
+
+    def test_declared_fields_round_trip(self):
+        published = datetime(2020, 1, 2, 3, 4, 5, 600000)
+        post = TypedPost(user_id="u1", n=500, score=0.1, price="1.50", published=published, draft=False, body=b"abc",
+                         tags=["a", ""], counts={"likes":3}, user=self.users[1], other=1.5, _attempt_load=False)
+        post._save()
+        item = self.backend.Table("posts").get_item(Key={"user_id":"u1", "n":500})["Item"]
+        self.assertEqual(Decimal("0.1"), item["score"])
+        self.assertEqual(Decimal("1.50"), item["price"])
+        self.assertTrue(item["published"].startswith("datetime:"))
+        loaded = TypedPost.load(user_id="u1", n=500)
+        self.assertEqual((500, 0.1, Decimal("1.50"), published, False, b"abc"), (loaded.n, loaded.score, loaded.price, loaded.published, loaded.draft, loaded.body))
+        self.assertEqual(int, type(loaded.n))
+        self.assertEqual(["a", ""], loaded.tags)
+        self.assertEqual({"likes":3}, loaded.counts)
+        self.assertEqual("user 1", loaded.user.name)
+        # Undeclared attributes are handled as before.
+        self.assertEqual(Decimal("1.5"), loaded.other)
+
+    def test_decoded_values_are_kept_until_changed(self):
+        TypedPost(user_id="u1", n=501, published=datetime(2020, 1, 1), tags=["a"], _attempt_load=False)._save()
+        post = TypedPost._from_raw_item(self.backend.Table("posts").get_item(Key={"user_id":"u1", "n":501})["Item"])
+        self.assertIs(post.published, post.published)
+        post.tags.append("b")
+        post.published = datetime(2021, 1, 1)
+        self.assertEqual(2021, post.published.year)
+        post._save()
+        loaded = TypedPost.load(user_id="u1", n=501)
+        self.assertEqual(["a", "b"], loaded.tags)
+        self.assertEqual(datetime(2021, 1, 1), loaded.published)
+
+    def test_foreign_key_checks_class(self):
+        post = TypedPost(user_id="u1", n=502, _attempt_load=False)
+        with self.assertRaises(RuntimeError):
+            post.user = self.posts[0]
+        post.user = self.users[2]
+        post._save()
+        self.assertEqual("user 2", TypedPost.load(user_id="u1", n=502).user.name)
+
+class TestGather(TocoTestCase):
+
+    def test_mixed_requests_keep_order_and_report_misses(self):
+        requests = [(Post, {"user_id":"u1", "n":1}), self.users[3]._foreign_key(), (User, {"id":"missing"})]
+        requests += [(Post, {"user_id":"u{}".format(n % 5), "n":n}) for n in range(2, 101)]
+        exported = []
+        active = instrumentation.enable(exporter=exported.append)
+        try:
+            result = toco.gather(requests, max_workers=4)
+            active.export()
+        finally:
+            instrumentation.disable()
+        # 101 distinct keys across two tables, so two BatchGetItem calls.
+        self.assertEqual(2, exported[0]["operations"]["tests.object_test.Post"]["batch_get_item"]["calls"])
+        self.assertEqual([1, None, None] + list(range(2, 101)), [getattr(obj, "n") if obj else None for obj in result["Items"]])
+        self.assertEqual("user 3", result["Items"][1].name)
+        self.assertEqual([(User, {"id":"missing"})], result["Missing"])
+
+class TestAio(TocoTestCase):
+
+    def test_load_save_and_resolve(self):
+        async def work():
+            users = await asyncio.gather(*[User.aload(id="u{}".format(i)) for i in range(5)])
+            users[0].name = "renamed"
+            await users[0].asave()
+            post = await Post.aload(user_id="u0", n=5)
+            author = await post.aresolve("user")
+            self.assertFalse(author._needs_reloaded)
+            return users, author
+        users, author = asyncio.run(work())
+        self.assertEqual(["user {}".format(i) for i in range(1, 5)], [u.name for u in users[1:]])
+        self.assertEqual("renamed", author.name)
+
+    def test_iter_query_and_table_limit(self):
+        self.addCleanup(aio.configure, table_concurrency=aio.TABLE_CONCURRENCY)
+        aio.configure(table_concurrency=2)
+        async def work():
+            posts = [post async for post in Post.aiter_query(user_id="u1", Limit=3, max_items=10)]
+            with toco.session():
+                loaded = await asyncio.gather(*[Post.aload(user_id="u1", n=post.n) for post in posts])
+            # The limit belongs to the table, not the class.
+            self.assertIs(aio._limit(Post), aio._limit(StrictPost))
+            self.assertIsNot(aio._limit(Post), aio._limit(User))
+            return posts, loaded
+        posts, loaded = asyncio.run(work())
+        self.assertEqual([1, 6, 11, 16, 21, 26, 31, 36, 41, 46], [post.n for post in posts])
+        self.assertEqual([post.n for post in posts], [post.n for post in loaded])
+
+class FakeCloudFormation(object):
+    '''
+    Just enough of a CloudFormation client for CFObject, counting the calls made.
+    '''
+    def __init__(self, updated="2020-01-01"):
+        self.updated = updated
+        self.calls = 0
+
+    def describe_stacks(self, StackName):
+        self.calls += 1
+        return {"Stacks":[{"StackName":StackName, "CreationTime":"2019-01-01", "LastUpdatedTime":self.updated}]}
+
+    def get_template(self, StackName):
+        self.calls += 1
+        properties = {
+            "KeySchema":[{"AttributeName":"id","KeyType":"HASH"}],
+            "AttributeDefinitions":[{"AttributeName":"id","AttributeType":"S"}],
+        }
+        return {"TemplateBody":{"Resources":{"Things":{"Type":"AWS::DynamoDB::Table", "Properties":properties}}}}
+
+    def describe_stack_resource(self, StackName, LogicalResourceId):
+        self.calls += 1
+        return {"StackResourceDetail":{"LogicalResourceId":LogicalResourceId, "PhysicalResourceId":"{}-{}-ABC".format(StackName, LogicalResourceId)}}
+
+class TestCFCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.client = FakeCloudFormation()
+        class Thing(CFObject):
+            _CF_CLIENT = self.client
+            _CF_CACHE_FILE = os.path.join(directory.name, "cf.json")
+            _CF_STACK_NAME = "stack"
+            _CF_LOGICAL_NAME = "Things"
+            _CF_RESOURCES = {}
+        self.Thing = Thing
+
+    def test_new_processes_read_from_the_file(self):
+        self.assertEqual({self.Thing:"stack-Things-ABC"}, toco.cfcache.prebuild([self.Thing]))
+        calls = self.client.calls
+        # Clearing just the in-memory caches is what a fresh process looks like.
+        self.Thing._clear_cf_cache(persistent=False)
+        self.assertEqual("stack-Things-ABC", self.Thing.TABLE_NAME())
+        self.assertEqual(calls, self.client.calls)
+        self.Thing._clear_cf_cache()
+        self.Thing.TABLE_NAME()
+        self.assertGreater(self.client.calls, calls)
+
+    def test_unwritable_file_falls_back_to_memory(self):
+        # A path inside a regular file can't be written, even by root.
+        self.Thing._CF_CACHE_FILE = os.path.join(self.Thing._CF_CACHE_FILE + ".d", "cf.json")
+        open(os.path.dirname(self.Thing._CF_CACHE_FILE), "w").close()
+        with self.assertLogs("toco.cfcache", "WARNING"):
+            self.assertEqual("stack-Things-ABC", self.Thing.TABLE_NAME())
+        self.Thing._clear_cf_cache(persistent=False)
+        calls = self.client.calls
+        self.assertEqual("stack-Things-ABC", self.Thing.TABLE_NAME())
+        self.assertEqual(calls, self.client.calls)
+        self.Thing._clear_cf_cache()
+        self.assertEqual("stack-Things-ABC", self.Thing.TABLE_NAME())
+        self.assertGreater(self.client.calls, calls)
+
+    def test_verify_ignores_entries_from_older_stack_versions(self):
+        toco.cfcache.prebuild([self.Thing])
+        self.Thing._CF_CACHE_VERIFY = True
+        self.Thing._clear_cf_cache(persistent=False)
+        calls = self.client.calls
+        self.Thing.TABLE_NAME()
+        # Just the DescribeStacks call to check the version.
+        self.assertEqual(calls + 1, self.client.calls)
+        self.client.updated = "2021-01-01"
+        self.Thing._clear_cf_cache(persistent=False)
+        calls = self.client.calls
+        self.Thing.TABLE_NAME()
+        self.assertEqual(calls + 3, self.client.calls)
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(toco.backend.set_backend, None)
+        self.addCleanup(setattr, toco.config, "_CONFIG", toco.config.get_config())
+
+    def test_default_backend_uses_settings(self):
+        toco.config.configure(region_name="us-east-1", max_pool_connections=64, read_timeout=3, max_attempts=4)
+        backend = toco.backend.get_backend()
+        self.assertIs(backend.client, backend.client)
+        settings = backend.client.meta.config
+        self.assertEqual((64, 3, True), (settings.max_pool_connections, settings.read_timeout, settings.tcp_keepalive))
+        self.assertEqual({"mode":"standard", "total_max_attempts":4}, settings.retries)
+        # Changing the settings replaces the default backend, and so the pool, and the CloudFormation client.
+        self.addCleanup(setattr, CFObject, "_CF_CLIENT", CFObject._CF_CLIENT)
+        CFObject._CF_CLIENT = FakeCloudFormation()
+        toco.config.configure(max_pool_connections=8)
+        self.assertIsNot(backend, toco.backend.get_backend())
+        self.assertIsNone(CFObject._CF_CLIENT)
+
+    def test_threads_share_the_client_but_not_resources(self):
+        backend = toco.backend.Boto3Backend(region_name="us-east-1")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            other = executor.submit(lambda: (backend.resource, backend.Table("users"))).result()
+        self.assertIs(backend.Table("users"), backend.Table("users"))
+        self.assertIsNot(other[0], backend.resource)
+        self.assertIsNot(other[1], backend.Table("users"))
+        self.assertIs(backend.client, other[0].meta.client)
+        self.assertIs(backend.client, backend.Table("users").meta.client)
+
+    def test_transactions_send_wire_format(self):
+        from boto3.dynamodb.conditions import Attr
+        from botocore.stub import Stubber
+        backend = toco.backend.Boto3Backend(region_name="us-east-1")
+        client = backend.client
+        sent = []
+        with Stubber(client) as stubber:
+            # Registered after the stubber's own handler, so that this one runs first and sees what would have been sent.
+            # botocore only holds a weak reference to it.
+            record = lambda params, **kwargs: sent.append(json.loads(params["body"]))
+            client.meta.events.register_first("before-call.*.*", record)
+            stubber.add_response("transact_write_items", {})
+            backend.transact_write_items(TransactItems=[{"Put":{"TableName":"users", "Item":{"id":"u1", "n":1}, "ConditionExpression":Attr("id").not_exists()}}])
+            stubber.add_response("transact_get_items", {"Responses":[{"Item":{"id":{"S":"u1"}, "n":{"N":"1"}}}]})
+            response = backend.transact_get_items(TransactItems=[{"Get":{"TableName":"users", "Key":{"id":"u1"}}}])
+            stubber.assert_no_pending_responses()
+        self.assertEqual([{"Put":{
+            "TableName":"users",
+            "Item":{"id":{"S":"u1"}, "n":{"N":"1"}},
+            "ConditionExpression":"attribute_not_exists(#n0)",
+            "ExpressionAttributeNames":{"#n0":"id"},
+        }}], sent[0]["TransactItems"])
+        self.assertEqual([{"Get":{"TableName":"users", "Key":{"id":{"S":"u1"}}}}], sent[1]["TransactItems"])
+        self.assertEqual([{"Item":{"id":"u1", "n":1}}], response["Responses"])
+
+    def test_prewarm_skips_other_backends(self):
+        toco.backend.set_backend(MemoryBackend())
+        self.assertEqual(0, toco.config.prewarm())
+
+class TestInstrumentation(TocoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.exported = []
+        self.instrumentation = instrumentation.enable(exporter=self.exported.append)
+
+    def tearDown(self):
+        instrumentation.disable()
+        super().tearDown()
+
+    def test_records_calls_and_lazy_loads(self):
+        posts = Post.query(user_id="u1")["Items"]
+        for post in posts[:3]:
+            post.user.name
+        self.instrumentation.export()
+        snapshot = self.exported[0]
+        query = snapshot["operations"]["tests.object_test.Post"]["query"]
+        self.assertEqual(1, query["calls"])
+        self.assertEqual(len(posts), query["items"])
+        self.assertGreater(query["consumed_capacity"], 0)
+        self.assertIsNotNone(query["latency"]["p99"])
+        self.assertEqual(3, snapshot["events"]["tests.object_test.Post"]["lazy_fkey_load:user"])
+        self.assertEqual(3, snapshot["events"]["tests.object_test.User"]["lazy_reload"])
+        self.assertEqual(3, snapshot["operations"]["tests.object_test.User"]["get_item"]["calls"])
+
+    def test_records_botocore_retries(self):
+        self.instrumentation.call(Post, "get_item", lambda **params: {"ResponseMetadata":{"RetryAttempts":2}}, {})
+        def throttled(**params):
+            raise ClientError({"Error":{"Code":"ProvisionedThroughputExceededException"}, "ResponseMetadata":{"RetryAttempts":4}}, "PutItem")
+        with self.assertRaises(ClientError):
+            self.instrumentation.call(Post, "put_item", throttled, {})
+        operations = self.instrumentation.snapshot()["operations"]["tests.object_test.Post"]
+        self.assertEqual((2, 4), (operations["get_item"]["retries"], operations["put_item"]["retries"]))
+
 if __name__ == '__main__':
     unittest.main()